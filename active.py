@@ -0,0 +1,68 @@
+import logging
+import time
+
+from db import fetch_active_user_ts, rebuild_active_users, expire_active_users, set_member_statuses
+
+log = logging.getLogger("rothko-bot.active")
+
+# Users who posted within the active window, per chat: {chat_id: {user_id: last_ts}}.
+# ingest keeps it current as messages are flushed, sweep_active() expires old
+# entries, and the active_users table mirrors it so a restart only reloads it.
+_last = {}
+_window = 7 * 86400
+
+def window_days():
+    return _window // 86400
+
+def active_since():
+    return int(time.time()) - _window
+
+async def load_active(chat_ids, days = 7):
+    global _window
+    _window = max(1, days) * 86400
+    since = active_since()
+    await expire_active_users(since)
+    rows = await fetch_active_user_ts(since)
+    missing = set(chat_ids) - {chat_id for chat_id, _, _ in rows}
+    if missing:
+        # a chat new to the table (or a quiet week): one scan of its window
+        for chat_id in missing:
+            await rebuild_active_users(chat_id, since)
+        rows = await fetch_active_user_ts(since)
+    _last.clear()
+    note_active(rows)
+    log.info("Loaded %d active users", len(rows))
+
+def note_active(rows):
+    """(chat_id, user_id, last_ts) rows from ingest_batch."""
+    since = active_since()
+    for chat_id, user_id, ts in rows:
+        if ts < since:
+            continue
+        users = _last.setdefault(chat_id, {})
+        if ts > users.get(user_id, since - 1):
+            users[user_id] = ts
+
+def forget_active(chat_id, user_id):
+    _last.get(chat_id, {}).pop(user_id, None)
+
+def active_count(chat_id):
+    return len(_last.get(chat_id, ()))
+
+async def sweep_active():
+    since = active_since()
+    dropped = 0
+    for users in _last.values():
+        stale = [uid for uid, ts in users.items() if ts < since]
+        for uid in stale:
+            del users[uid]
+        dropped += len(stale)
+    await expire_active_users(since)
+    return dropped
+
+async def update_member_statuses(rows):
+    """set_member_statuses, also dropping users who left or were kicked from the active set."""
+    await set_member_statuses(rows)
+    for chat_id, user_id, status, _ in rows:
+        if status in ("left", "kicked"):
+            forget_active(chat_id, user_id)
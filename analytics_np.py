@@ -0,0 +1,71 @@
+from db import fetch_daily_user_counts, fetch_hour_counts
+from util import tz_table
+
+try:
+    import numpy as np
+except ImportError:  # optional: analytics_backend = "numpy" falls back to SQL without it
+    np = None
+
+# Columnar versions of the rollup queries behind /metrics, /heatmap and
+# /leaders: one read per window into int64 arrays, then bincount/unique
+# instead of GROUP BY per statistic. Results match the SQL path exactly,
+# so the reports share their formatting code.
+
+def available():
+    return np is not None
+
+def quantiles(ps, values):
+    """Same linear interpolation as util.percentiles."""
+    if len(values) == 0:
+        return [0.0 for _ in ps]
+    return np.quantile(np.asarray(values, dtype=np.float64), ps).tolist()
+
+def _columns(rows, width):
+    return np.array(rows, dtype=np.int64).reshape(-1, width).T
+
+def _per_user(uid, values):
+    users, inv = np.unique(uid, return_inverse=True)
+    return users, np.bincount(inv, weights=values, minlength=len(users)).astype(np.int64)
+
+def _top(users, counts, limit):
+    # ORDER BY n DESC, user_id ASC, skipping zero totals
+    order = np.lexsort((users, -counts))
+    order = order[counts[order] > 0][:limit]
+    return list(zip(users[order].tolist(), counts[order].tolist()))
+
+async def metrics_data(chat_id, start_day, end_day, days):
+    """Everything metrics_summary needs from daily_user_counts, for this window and the previous one."""
+    day, uid, msgs, replies = _columns(await fetch_daily_user_counts(chat_id, start_day - days, end_day), 4)
+    cur = day >= start_day
+    users, user_msgs = _per_user(uid[cur], msgs[cur])
+    _, user_replies = _per_user(uid[cur], replies[cur])
+    days_seen, day_msgs = _per_user(day[cur], msgs[cur])
+    return {
+        "msgs": int(msgs[cur].sum()),
+        "replies": int(replies[cur].sum()),
+        "users": len(users),
+        "prev_msgs": int(msgs[~cur].sum()),
+        "counts": np.sort(user_msgs),
+        "top": _top(users, user_msgs, 5),
+        "top_replies": _top(users, user_replies, 5),
+        "by_day": list(zip(days_seen.tolist(), day_msgs.tolist())),
+    }
+
+async def leaders_data(chat_id, start_day, end_day, limit):
+    _, uid, msgs, _ = _columns(await fetch_daily_user_counts(chat_id, start_day, end_day), 4)
+    users, user_msgs = _per_user(uid, msgs)
+    return _top(users, user_msgs, limit), np.sort(user_msgs)
+
+async def heatmap_counts(chat_id, start_hour, tz):
+    """{(weekday, local hour): msgs} over hourly_counts from start_hour on."""
+    rows = await fetch_hour_counts(chat_id, start_hour)
+    if not rows:
+        return {}
+    hours, msgs = _columns([tuple(r) for r in rows], 2)
+    table = tz_table(tz)
+    ts = hours * 3600
+    local = ts + np.asarray(table.offsets, dtype=np.int64)[np.searchsorted(table.starts, ts, side="right") - 1]
+    weekday = (local // 86400 + 3) % 7  # 1970-01-01 was a Thursday
+    cell = weekday * 24 + (local % 86400) // 3600
+    counts = np.bincount(cell, weights=msgs, minlength=7 * 24).astype(np.int64)
+    return {(i // 24, i % 24): n for i, n in enumerate(counts.tolist()) if n}
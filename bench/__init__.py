@@ -0,0 +1,9 @@
+"""Benchmarks for the analytics and ingestion paths.
+
+    python -m bench.run --users 10000 --messages 10000000 --out bench_results.json
+
+Synthetic history is generated into a temporary SQLite file (see
+bench.generate), then every report, the fetch_* queries and ingestion
+through message_tracker are timed. Results are written as JSON so runs
+can be diffed against each other.
+"""
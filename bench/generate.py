@@ -0,0 +1,72 @@
+import random
+import sqlite3
+
+# Relative message volume per local hour of day, so the heatmap has a shape.
+HOUR_WEIGHTS = [2, 1, 1, 1, 1, 1, 2, 4, 6, 7, 8, 8, 9, 9, 8, 8, 8, 9, 10, 11, 11, 10, 7, 4]
+
+def _user_weights(users, skew):
+    # Zipf-like: a few users write most of the messages.
+    return [1 / (rank ** skew) for rank in range(1, users + 1)]
+
+def generate(path, *, chat_id, channel_id, users, messages, days, now, seed = 1,
+             reply_share = 0.3, thread_share = 0.1, posts = 1000, skew = 1.1, chunk = 50000):
+    """Fill the (already initialised) database at `path` with synthetic history.
+
+    Messages are spread over `days` days before `now`, in time order, with
+    reply chains to recent messages and a few forum threads. Returns the
+    number of message rows written.
+    """
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    user_ids = list(range(1000, 1000 + users))
+    conn.executemany(
+        "INSERT OR REPLACE INTO activity(chat_id, user_id, username, first_name, last_name, is_bot, joined_ts) VALUES (?,?,?,?,?,0,?)",
+        ((chat_id, uid, f"user{uid}" if rnd.random() < 0.8 else None, f"Name{uid}", None, now - days * 86400) for uid in user_ids),
+    )
+    gone = rnd.sample(user_ids, users // 20)
+    conn.executemany(
+        "INSERT OR REPLACE INTO members(chat_id, user_id, status, updated_ts) VALUES (?,?,?,?)",
+        ((chat_id, uid, rnd.choice(("left", "kicked")), now) for uid in gone),
+    )
+    weights = _user_weights(users, skew)
+    start = now - days * 86400
+    per_day = messages // days
+    extra = messages - per_day * days
+    message_id = 0
+    recent = []
+    batch = []
+    written = 0
+    for day in range(days):
+        count = per_day + (1 if day < extra else 0)
+        hours = rnd.choices(range(24), weights=HOUR_WEIGHTS, k=count)
+        offsets = sorted(h * 3600 + rnd.randrange(3600) for h in hours)
+        authors = rnd.choices(user_ids, weights=weights, k=count)
+        for offset, author in zip(offsets, authors):
+            message_id += 1
+            ts = start + day * 86400 + offset
+            reply_to = rnd.choice(recent) if recent and rnd.random() < reply_share else None
+            thread_id = rnd.randint(1, 20) if rnd.random() < thread_share else None
+            batch.append((chat_id, message_id, author, ts, reply_to, thread_id))
+            recent.append(message_id)
+            if len(recent) > 50:
+                recent.pop(0)
+            if len(batch) >= chunk:
+                conn.executemany("INSERT INTO messages(chat_id, message_id, user_id, ts, reply_to_message_id, thread_id) VALUES (?,?,?,?,?,?)", batch)
+                conn.commit()
+                written += len(batch)
+                batch = []
+    if batch:
+        conn.executemany("INSERT INTO messages(chat_id, message_id, user_id, ts, reply_to_message_id, thread_id) VALUES (?,?,?,?,?,?)", batch)
+        written += len(batch)
+    conn.executemany(
+        "INSERT INTO scheduled_posts(channel_id, run_at_ts, file_id, status) VALUES (?,?,?,?)",
+        (
+            (channel_id, start + rnd.randrange(days * 86400 + 30 * 86400), f"file-{i}", "pending" if rnd.random() < 0.3 else "sent")
+            for i in range(posts)
+        ),
+    )
+    conn.commit()
+    conn.close()
+    return written
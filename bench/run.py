@@ -0,0 +1,169 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from bench.generate import generate
+
+CHAT_ID = -1001000000000
+CHANNEL_ID = -1002000000000
+
+def _parse_args(argv):
+    p = argparse.ArgumentParser(description="Benchmark analytics and ingestion on synthetic chat history.")
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--messages", type=int, default=100_000)
+    p.add_argument("--days", type=int, default=365)
+    p.add_argument("--posts", type=int, default=1000)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--repeat", type=int, default=5, help="runs per timed query")
+    p.add_argument("--ingest", type=int, default=20_000, help="messages pushed through message_tracker")
+    p.add_argument("--db", help="SQLite file to use; generated only if it does not exist yet")
+    p.add_argument("--out", default="bench_results.json")
+    return p.parse_args(argv)
+
+def _write_config(tmpdir):
+    # bot/config read config.json at import time, so point them at a throwaway one.
+    path = Path(tmpdir) / "config.json"
+    path.write_text(json.dumps({"token": "0:bench", "chat_id": CHAT_ID, "channel_id": CHANNEL_ID}))
+    os.environ["ROTKOBOT_CONFIG"] = str(path)
+
+def _summary(samples):
+    return {
+        "runs": len(samples),
+        "min_ms": round(min(samples) * 1000, 3),
+        "median_ms": round(statistics.median(samples) * 1000, 3),
+        "max_ms": round(max(samples) * 1000, 3),
+    }
+
+async def _time(results, name, make_call, repeat):
+    from cache import report_cache
+    samples = []
+    for _ in range(repeat):
+        report_cache.clear()
+        started = time.perf_counter()
+        await make_call()
+        samples.append(time.perf_counter() - started)
+    results[name] = _summary(samples)
+
+def _stub_update(chat, user_id, message_id, reply_to):
+    user = SimpleNamespace(id=user_id, username=f"user{user_id}", first_name=f"Name{user_id}", last_name=None, is_bot=False)
+    msg = SimpleNamespace(
+        message_id=message_id,
+        reply_to_message=SimpleNamespace(message_id=reply_to) if reply_to else None,
+        message_thread_id=None,
+    )
+    return SimpleNamespace(effective_chat=chat, effective_user=user, effective_message=msg)
+
+async def _bench_ingest(results, count, users, first_message_id):
+    import bot
+    from ingest import start_ingest, stop_ingest
+    chat = SimpleNamespace(id=CHAT_ID, type="supergroup")
+    updates = [
+        _stub_update(chat, 1000 + i % users, first_message_id + i, first_message_id + i - 1 if i % 3 == 0 and i else None)
+        for i in range(count)
+    ]
+    await start_ingest()
+    started = time.perf_counter()
+    for update in updates:
+        await bot.message_tracker(update, None)
+    enqueued = time.perf_counter() - started
+    await stop_ingest()
+    total = time.perf_counter() - started
+    results["ingest.message_tracker"] = {
+        "messages": count,
+        "enqueue_ms": round(enqueued * 1000, 3),
+        "total_ms": round(total * 1000, 3),
+        "messages_per_sec": round(count / total, 1) if total else None,
+    }
+
+async def _run(args, db_path, meta):
+    import db
+    import bot
+    import latency
+    results = {}
+    await db.init_db(db_path)
+    try:
+        started = time.perf_counter()
+        await bot.backfill_rollups(CHAT_ID)
+        results["backfill_rollups"] = _summary([time.perf_counter() - started])
+        started = time.perf_counter()
+        await bot.load_active([CHAT_ID], 7)
+        results["load_active"] = _summary([time.perf_counter() - started])
+
+        now = int(time.time())
+        week_ago = now - 7 * 86400
+        repeat = args.repeat
+        reports = {
+            "metrics_summary(7)": lambda: bot.metrics_summary(CHAT_ID, 7),
+            "metrics_summary(90)": lambda: bot.metrics_summary(CHAT_ID, 90),
+            "_heatmap_text(30)": lambda: bot._heatmap_text(CHAT_ID, 30),
+            "_heatmap_text(180)": lambda: bot._heatmap_text(CHAT_ID, 180),
+            "_leaders_text(30)": lambda: bot._leaders_text(CHAT_ID, 30),
+            "_leaders_text(365)": lambda: bot._leaders_text(CHAT_ID, 365),
+            "_streaks_text()": lambda: bot._streaks_text(CHAT_ID),
+            "_reply_latency_text()": lambda: bot._reply_latency_text(CHAT_ID),
+        }
+        queries = {
+            "fetch_all_users": lambda: db.fetch_all_users(CHAT_ID, 50),
+            "fetch_active_users": lambda: db.fetch_active_users(CHAT_ID, week_ago, 50),
+            "fetch_silent_users": lambda: db.fetch_silent_users(CHAT_ID, week_ago, 50),
+            "fetch_inactive_users": lambda: db.fetch_inactive_users(CHAT_ID, week_ago, now - 400 * 86400, 50),
+            "fetch_first_msg_ts_per_user": lambda: db.fetch_first_msg_ts_per_user(CHAT_ID),
+            "fetch_last_msg_ts_per_user": lambda: db.fetch_last_msg_ts_per_user(CHAT_ID),
+            "reply_sketch(90d)": lambda: latency.reply_sketch(CHAT_ID, bot.local_day(now, bot.timezone_(CHAT_ID)) - 89, bot.local_day(now, bot.timezone_(CHAT_ID))),
+            "fetch_scheduled_posts": lambda: db.fetch_scheduled_posts(CHANNEL_ID),
+        }
+        for name, call in {**reports, **queries}.items():
+            await _time(results, name, call, repeat)
+
+        async with db.db_read() as conn:
+            cur = await conn.execute("SELECT COALESCE(MAX(message_id), 0) AS m FROM messages WHERE chat_id=?", (CHAT_ID,))
+            max_id = (await cur.fetchone())["m"]
+        await _bench_ingest(results, args.ingest, args.users, max_id + 1)
+    finally:
+        await db.close_db()
+    return {"meta": meta, "results": results}
+
+def main(argv = None):
+    args = _parse_args(argv if argv is not None else sys.argv[1:])
+    with tempfile.TemporaryDirectory(prefix="rotkobench-") as tmpdir:
+        _write_config(tmpdir)
+        import db
+        db_path = args.db or str(Path(tmpdir) / "bench.sqlite3")
+        meta = {
+            "users": args.users,
+            "messages": args.messages,
+            "days": args.days,
+            "seed": args.seed,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "started_at": int(time.time()),
+        }
+        if not os.path.exists(db_path):
+            asyncio.run(db.init_db(db_path))
+            asyncio.run(db.close_db())
+            started = time.perf_counter()
+            written = generate(
+                db_path, chat_id=CHAT_ID, channel_id=CHANNEL_ID, users=args.users, messages=args.messages,
+                days=args.days, now=int(time.time()), seed=args.seed, posts=args.posts,
+            )
+            meta["generate_sec"] = round(time.perf_counter() - started, 3)
+            meta["generated_messages"] = written
+        report = asyncio.run(_run(args, db_path, meta))
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    width = max(len(name) for name in report["results"])
+    for name, stats in report["results"].items():
+        print(f"{name:<{width}}  {stats}")
+    print(f"Results written to {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,33 @@
 import time
-import asyncio
 import logging
 import random
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
 from datetime import time as dtime
+from telegram import ChatMember, ChatMemberRestricted, Update
 from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     ConversationHandler,
+    ChatMemberHandler,
+    TypeHandler,
     filters,
 )
 
 from config import CONFIG
-from db import init_db, upsert_user, delete_user, fetch_messages_since, fetch_first_msg_ts_per_user, fetch_last_msg_ts_per_user, user_display_names, add_scheduled_post, fetch_all_users, fetch_active_users, insert_message, fetch_scheduled_posts, fetch_inactive_users, fetch_all_scheduled_posts,  fetch_scheduled_post, change_scheduled_post_status
-from util import requires_auth, owners_only, percentile, timezone_, rules_timezone, localize, get_rules_text, parse_hhmm, escape_md, get_job_queue, NOTHING_PERMITTED, EVERYTHING_PERMITTED, months_ru
+from db import init_db, close_db, upsert_user, fetch_last_msg_ts_per_user, user_display_names, find_users_by_username, add_scheduled_posts, fetch_all_users, fetch_active_users, fetch_silent_users, fetch_scheduled_posts, fetch_inactive_users, count_all_users, count_inactive_users, fetch_window_totals, fetch_user_count_values, fetch_top_users, count_new_users, fetch_day_counts, fetch_activity_days, fetch_hour_counts, rebuild_daily_counts, rebuild_hourly_counts, rebuild_activity_days, rebuild_reply_stats, delete_reply_sketches, rollups_need_backfill, enable_incremental_vacuum
+import daybits
+import analytics_np
+from latency import reply_sketch
+from cache import cached_report, report_cache
+from instrument import timed, InstrumentedRequest, flush_metrics, latency_report
+from ratelimit import api
+from ingest import start_ingest, stop_ingest, enqueue_message, enqueue_profile, enqueue_delete
+from dispatcher import catch_up, start_dispatcher, stop_dispatcher, notify_scheduled
+from retention import run_retention, compacted_before
+from active import load_active, sweep_active, active_count, active_since, window_days, update_member_statuses
+from util import requires_auth, owners_only, percentiles, timezone_, rules_timezone, chat_ids, is_tracked, chat_setting, localize, encode_cursor, decode_cursor, local_day, tz_table, day_to_date, day_start_ts, get_rules_text, parse_hhmm, escape_md, get_job_queue, NOTHING_PERMITTED, EVERYTHING_PERMITTED, months_ru
 
 logging.basicConfig(
     format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
@@ -23,55 +35,63 @@ logging.basicConfig(
 )
 log = logging.getLogger("rothko-bot")
 
-async def metrics_summary(days = 7):
-    tz = timezone_()
+def _numpy_backend():
+    """analytics_backend = "numpy" turns on analytics_np when NumPy is installed."""
+    if CONFIG.get("analytics_backend") != "numpy":
+        return False
+    if not analytics_np.available():
+        log.warning("analytics_backend is numpy but NumPy is not installed; using SQL")
+        CONFIG["analytics_backend"] = "sqlite"
+        return False
+    return True
+
+async def _metrics_data(chat_id, start_day, end_day, days):
+    if _numpy_backend():
+        return await analytics_np.metrics_data(chat_id, start_day, end_day, days)
+    cur = await fetch_window_totals(chat_id, start_day, end_day)
+    prev = await fetch_window_totals(chat_id, start_day - days, start_day - 1)
+    return {
+        "msgs": cur["msgs"],
+        "replies": cur["replies"],
+        "users": cur["users"],
+        "prev_msgs": prev["msgs"],
+        "counts": await fetch_user_count_values(chat_id, start_day, end_day),
+        "top": await fetch_top_users(chat_id, start_day, end_day, 5),
+        "top_replies": await fetch_top_users(chat_id, start_day, end_day, 5, column="replies"),
+        "by_day": [(r["day"], r["msgs"]) for r in await fetch_day_counts(chat_id, start_day, end_day)],
+    }
+
+@cached_report("metrics")
+async def metrics_summary(chat_id, days = 7):
+    tz = timezone_(chat_id)
     now = int(time.time())
-    start = now - days * 86400
-    prev_start = start - days * 86400
-    rows = await fetch_messages_since(prev_start, CONFIG.get("chat_id"))
-    cur_msgs = [r for r in rows if r["ts"] >= start]
-    prev_msgs = [r for r in rows if prev_start <= r["ts"] < start]
-    total_cur = len(cur_msgs)
-    total_prev = len(prev_msgs)
-    delta_total = total_cur - total_prev
-    from collections import Counter, defaultdict
-    cnt_cur = Counter(r["user_id"] for r in cur_msgs)
-    cnt_prev = Counter(r["user_id"] for r in prev_msgs)
-    counts_list = list(cnt_cur.values())
-    p50 = percentile(0.5, counts_list)
-    p90 = percentile(0.9, counts_list)
-    p99 = percentile(0.99, counts_list)
-    top = cnt_cur.most_common(5)
-    names = await user_display_names([uid for uid,_ in top])
-    first_ts = await fetch_first_msg_ts_per_user(CONFIG.get("chat_id"))
-    new_users = {u for u in cnt_cur if first_ts.get(u, 1e18) >= start}
-    ret_users = set(cnt_cur.keys()) - new_users
-    reply_count = sum(1 for r in cur_msgs if r["reply_to_message_id"] is not None)
+    # whole local days only: a partial today against a full previous day would bias the trend down
+    end_day = local_day(now, tz) - 1
+    start_day = end_day - days + 1
+    start = day_start_ts(start_day, tz)
+    data = await _metrics_data(chat_id, start_day, end_day, days)
+    pcts = analytics_np.quantiles if _numpy_backend() else percentiles
+    total_cur = data["msgs"]
+    delta_total = total_cur - data["prev_msgs"]
+    counts_list = data["counts"]
+    p50, p90, p99 = pcts((0.5, 0.9, 0.99), counts_list)
+    top = data["top"]
+    names = await user_display_names(chat_id, [uid for uid,_ in top])
+    # same calendar days as the message totals; the rolling 7×24h set behind /active would skew the ratios
+    users = data["users"]
+    new_users = await count_new_users(chat_id, start, day_start_ts(end_day + 1, tz))
+    ret_users = max(0, users - new_users)
+    reply_count = data["replies"]
     reply_share = (reply_count / total_cur * 100) if total_cur else 0.0
-    reply_user_counts = Counter(r["user_id"] for r in cur_msgs if r["reply_to_message_id"] is not None).most_common(5)
-    orig_map = {}
-    first_reply_delta = []
-    msg_by_id = { (r["chat_id"], r["message_id"]): r for r in rows }
-    replies_by_orig = defaultdict(list)
-    for r in rows:
-        if r["reply_to_message_id"] is not None:
-            replies_by_orig[(r["chat_id"], r["reply_to_message_id"])].append(r["ts"])
-    for r in cur_msgs:
-        key = (r["chat_id"], r["message_id"])
-        if key in replies_by_orig:
-            delta = min(replies_by_orig[key]) - r["ts"]
-            if delta >= 0:
-                first_reply_delta.append(delta)
-    median_rt = int(percentile(0.5, first_reply_delta)) if first_reply_delta else None
-    p95_rt = int(percentile(0.95, first_reply_delta)) if first_reply_delta else None
-    def daykey(ts):
-        return localize(ts, tz).strftime("%Y-%m-%d")
-    by_day = Counter(daykey(r["ts"]) for r in cur_msgs)
+    reply_user_counts = data["top_replies"]
+    latency = await reply_sketch(chat_id, start_day, end_day)
+    median_rt, p95_rt = (int(v) for v in latency.quantiles((0.5, 0.95))) if latency.count else (None, None)
+    by_day = {day_to_date(day).strftime("%Y-%m-%d"): n for day, n in data["by_day"]}
     trend = f"{'+' if delta_total>=0 else ''}{delta_total} vs prev {days}d"
     lines = []
-    lines.append(f"📊 Metrics (last {days}d) — total: {total_cur} messages ({trend})")
-    lines.append(f"👥 Active users: {len(cnt_cur)} (new: {len(new_users)}, returning: {len(ret_users)})")
-    if counts_list:
+    lines.append(f"📊 Metrics (last {days} full days) — total: {total_cur} messages ({trend})")
+    lines.append(f"👥 Active users: {users} (new: {new_users}, returning: {ret_users})")
+    if len(counts_list):
         lines.append(f"🏷️ Per-user msgs — p50: {int(p50)}, p90: {int(p90)}, p99: {int(p99)}")
     lines.append(f"💬 Replies: {reply_count} ({reply_share:.1f}%)")
     if median_rt is not None:
@@ -80,7 +100,7 @@ async def metrics_summary(days = 7):
         top_str = ", ".join(f"{names.get(uid, uid)}:{c}" for uid,c in top)
         lines.append(f"🏆 Top talkers: {top_str}")
     if reply_user_counts:
-        rnames = await user_display_names([uid for uid,_ in reply_user_counts])
+        rnames = await user_display_names(chat_id, [uid for uid,_ in reply_user_counts])
         rstr = ", ".join(f"{rnames.get(uid, uid)}:{c}" for uid,c in reply_user_counts)
         lines.append(f"↩️ Top repliers: {rstr}")
     if by_day:
@@ -88,16 +108,23 @@ async def metrics_summary(days = 7):
         lines.append("📅 By day: " + ", ".join(f"{d}:{n}" for d,n in show))
     return "\n".join(lines)
 
-async def _heatmap_text(days = 30):
-    tz = timezone_()
-    now = int(time.time())
-    start = now - days * 86400
-    rows = await fetch_messages_since(start)
+async def _heatmap_counts(chat_id, start_hour, tz):
+    if _numpy_backend():
+        return await analytics_np.heatmap_counts(chat_id, start_hour, tz)
     from collections import Counter
     counts = Counter()
-    for r in rows:
-        dt = localize(r["ts"], tz)
-        counts[(dt.weekday(), dt.hour)] += 1
+    table = tz_table(tz)
+    for r in await fetch_hour_counts(chat_id, start_hour):
+        counts[table.weekday_hour(r["hour"] * 3600)] += r["msgs"]
+    return counts
+
+@cached_report("heatmap")
+async def _heatmap_text(chat_id, days = 30):
+    tz = timezone_(chat_id)
+    now = int(time.time())
+    start = now - days * 86400
+    # Buckets are UTC hours; the zone's offset table puts each one in its local hour, DST included.
+    counts = await _heatmap_counts(chat_id, start // 3600, tz)
     hdr = "🗓️ Hourly/weekday heatmap (last %dd)\n" % days
     hdr += "     " + " ".join(f"{h:02d}" for h in range(24)) + "\n"
     lines = [hdr]
@@ -108,62 +135,73 @@ async def _heatmap_text(days = 30):
         lines.append(" ".join(row))
     return "\n".join(lines)
 
-async def _leaders_text(days = 30):
+@cached_report("leaders")
+async def _leaders_text(chat_id, days = 30):
+    tz = timezone_(chat_id)
     now = int(time.time())
-    start = now - days * 86400
-    from collections import Counter
-    rows = await fetch_messages_since(start)
-    cnt = Counter(r["user_id"] for r in rows)
-    top = cnt.most_common(15)
-    names = await user_display_names([u for u,_ in top])
+    today = local_day(now, tz)
+    if _numpy_backend():
+        top, vals = await analytics_np.leaders_data(chat_id, today - days + 1, today, 15)
+        pcts = analytics_np.quantiles
+    else:
+        top = await fetch_top_users(chat_id, today - days + 1, today, 15)
+        vals = await fetch_user_count_values(chat_id, today - days + 1, today)
+        pcts = percentiles
+    names = await user_display_names(chat_id, [u for u,_ in top])
     lines = [f"🏅 Top talkers (last {days}d):"]
     for i,(u,c) in enumerate(top, start=1):
         lines.append(f"{i:2d}. {names.get(u,u)} — {c}")
-    vals = list(cnt.values())
-    if vals:
-        p50 = int(percentile(0.5, vals)); p90=int(percentile(0.9, vals)); p99=int(percentile(0.99, vals))
+    if len(vals):
+        p50, p90, p99 = (int(v) for v in pcts((0.5, 0.9, 0.99), vals))
         lines.append(f"\nPercentiles — p50:{p50}, p90:{p90}, p99:{p99}")
     return "\n".join(lines)
 
-async def _streaks_text():
-    tz = timezone_()
+@cached_report("streaks")
+async def _streaks_text(chat_id):
+    tz = timezone_(chat_id)
     now = int(time.time())
-    start = now - 365*86400
-    rows = await fetch_messages_since(start)
-    from collections import defaultdict
-    by_user_dates = defaultdict(set)
-    for r in rows:
-        day = localize(r["ts"], tz).date()
-        by_user_dates[r["user_id"]].add(day)
-    def longest_streak(dates:set[datetime.date]) -> int:
-        if not dates: return 0
-        best = cur = 1
-        dates_sorted = sorted(dates)
-        for i in range(1, len(dates_sorted)):
-            if dates_sorted[i] == dates_sorted[i-1] + timedelta(days=1):
-                cur += 1
-                best = max(best, cur)
-            else:
-                cur = 1
-        return best
-    streaks = [(u, longest_streak(dates)) for u,dates in by_user_dates.items()]
+    today = local_day(now, tz)
+    start_day = today - 364
+    bitmaps = await fetch_activity_days(chat_id, start_day)
+    streaks = []
+    for u, (first_day, last_day, bits) in bitmaps.items():
+        best = daybits.longest_run(daybits.window(first_day, bits, start_day, today))
+        streaks.append((u, best, daybits.current_run(first_day, bits, today)))
     streaks.sort(key=lambda x:(-x[1], x[0]))
-    names = await user_display_names([u for u,_ in streaks[:10]])
+    names = await user_display_names(chat_id, [u for u,_,_ in streaks[:10]])
     lines = ["🔥 Longest active streaks (days, last 365d):"]
-    for u, s in streaks[:10]:
-        lines.append(f"{names.get(u,u)} — {s}")
-    last_ts = await fetch_last_msg_ts_per_user(CONFIG.get("chat_id"))
-    inact_days = CONFIG.get("inactivity_days", 7)
+    for u, s, current in streaks[:10]:
+        lines.append(f"{names.get(u,u)} — {s}" + (f" (now {current})" if current else ""))
+    last_ts = await fetch_last_msg_ts_per_user(chat_id)
+    inact_days = chat_setting(chat_id, "inactivity_days", 7)
     risk_threshold = now - (inact_days - 1)*86400
     risk = [(u, (now - ts)//86400) for u, ts in last_ts.items() if ts < risk_threshold]
     risk.sort(key=lambda x: -x[1])
     if risk:
-        names2 = await user_display_names([u for u,_ in risk[:10]])
+        names2 = await user_display_names(chat_id, [u for u,_ in risk[:10]])
         lines.append(f"\n⚠️ Users at risk (>{inact_days-1}d inactive):")
         for u, days in risk[:10]:
             lines.append(f"{names2.get(u,u)} — {days}d")
     return "\n".join(lines)
 
+def _fmt_secs(secs):
+    return f"{secs//60}m {secs%60}s"
+
+@cached_report("replytime")
+async def _reply_latency_text(chat_id):
+    tz = timezone_(chat_id)
+    now = int(time.time())
+    today = local_day(now, tz)
+    lines = ["⏱️ Time-to-first-reply:"]
+    for days in (7, 30, 90):
+        latency = await reply_sketch(chat_id, today - days + 1, today)
+        if not latency.count:
+            lines.append(f"{days}d — no replies")
+            continue
+        median_rt, p95_rt = (int(v) for v in latency.quantiles((0.5, 0.95)))
+        lines.append(f"{days}d — median: {_fmt_secs(median_rt)}; p95: {_fmt_secs(p95_rt)} ({latency.count} threads)")
+    return "\n".join(lines)
+
 @owners_only
 async def metrics_cmd(update, context):
     days = 7
@@ -172,7 +210,7 @@ async def metrics_cmd(update, context):
             days = max(1, min(90, int(context.args[0])))
         except Exception:
             pass
-    text = await metrics_summary(days)
+    text = await metrics_summary(target_chat(update, context), days)
     user = update.effective_user
     if user:
         try:
@@ -180,6 +218,39 @@ async def metrics_cmd(update, context):
         except Exception as e:
             log.warning("Could not DM metrics to %s: %s", user.id, e)
 
+@owners_only
+async def replytime_cmd(update, context):
+    text = await _reply_latency_text(target_chat(update, context))
+    user = update.effective_user
+    if user:
+        try:
+            await context.bot.send_message(user.id, text)
+        except Exception as e:
+            log.warning("Could not DM reply latency to %s: %s", user.id, e)
+
+@owners_only
+async def latency_cmd(update, context):
+    text = latency_report()
+    user = update.effective_user
+    if user:
+        try:
+            await context.bot.send_message(user.id, text)
+        except Exception as e:
+            log.warning("Could not DM latency report to %s: %s", user.id, e)
+
+async def flush_metrics_job(_):
+    await flush_metrics(CONFIG.get("metrics_dump_path"))
+
+async def retention_job(_):
+    for chat_id in chat_ids():
+        keep_days = chat_setting(chat_id, "retention_days")
+        if keep_days:
+            await run_retention(chat_id, keep_days, CONFIG.get("retention_batch_rows", 2000))
+
+async def sweep_active_job(_):
+    if await sweep_active():
+        report_cache.invalidate()
+
 @owners_only
 async def heatmap_cmd(update, context):
     days = 30
@@ -188,7 +259,7 @@ async def heatmap_cmd(update, context):
             days = max(7, min(180, int(context.args[0])))
         except Exception:
             pass
-    text = await _heatmap_text(days)
+    text = await _heatmap_text(target_chat(update, context), days)
     user = update.effective_user
     if user:
         try:
@@ -204,7 +275,7 @@ async def leaders_cmd(update, context):
             days = max(7, min(365, int(context.args[0])))
         except Exception:
             pass
-    text = await _leaders_text(days)
+    text = await _leaders_text(target_chat(update, context), days)
     user = update.effective_user
     if user:
         try:
@@ -214,7 +285,7 @@ async def leaders_cmd(update, context):
 
 @owners_only
 async def streaks_cmd(update, context):
-    text = await _streaks_text()
+    text = await _streaks_text(target_chat(update, context))
     user = update.effective_user
     if user:
         try:
@@ -222,41 +293,162 @@ async def streaks_cmd(update, context):
         except Exception as e:
             log.warning("Could not DM streaks to %s: %s", user.id, e)
 
+async def backfill_rollups(chat_id):
+    tz = timezone_(chat_id)
+    started = time.monotonic()
+    since = await compacted_before(chat_id)
+    n = await rebuild_daily_counts(chat_id, tz_table(tz).local_day, since_ts=since)
+    hours = await rebuild_hourly_counts(chat_id, since_ts=since)
+    await rebuild_activity_days(chat_id)
+    await rebuild_reply_stats(chat_id)
+    await delete_reply_sketches(chat_id)
+    report_cache.clear()
+    log.info("Rebuilt rollups for chat %s: %d user-day rows, %d hour buckets in %.1fs", chat_id, n, hours, time.monotonic() - started)
+    return n
+
 @owners_only
-async def active_cmd(update, context):
+async def backfill_cmd(update, context):
+    user = update.effective_user
+    chat_id = target_chat(update, context)
+    if not user or not chat_id:
+        return
+    n = await backfill_rollups(chat_id)
+    try:
+        await context.bot.send_message(user.id, f"Rollups rebuilt: {n} user-day rows.")
+    except Exception as e:
+        log.warning("Could not DM backfill result to %s: %s", user.id, e)
+
+@owners_only
+async def vacuum_setup_cmd(update, context):
+    """Разовое переключение базы на auto_vacuum=INCREMENTAL; полный VACUUM держит запись, запускать в тихое время."""
     user = update.effective_user
     if not user:
         return
-    chat_id = CONFIG.get("chat_id")
-    if not chat_id:
-        await context.bot.send_message(user.id, "chat_id not configured")
+    started = time.monotonic()
+    if await enable_incremental_vacuum():
+        text = f"Database switched to incremental auto_vacuum in {time.monotonic() - started:.1f}s."
+        log.info(text)
+    else:
+        text = "Database already uses incremental auto_vacuum."
+    try:
+        await context.bot.send_message(user.id, text)
+    except Exception as e:
+        log.warning("Could not DM vacuum result to %s: %s", user.id, e)
+
+def target_chat(update, context):
+    """Чат для отчётов и списков: группа, где вызвана команда, иначе выбранный через /chat, иначе первый из конфига."""
+    chat = update.effective_chat
+    if chat and is_tracked(chat.id):
+        return chat.id
+    chosen = context.user_data.get("chat_id")
+    if chosen is not None and is_tracked(chosen):
+        return chosen
+    return CONFIG.get("chat_id")
+
+@owners_only
+async def chat_cmd(update, context):
+    user = update.effective_user
+    if not user:
         return
-    # Parse arguments: page
-    page = 1
     if context.args:
         try:
-            page = max(1, int(context.args[0]))
+            chosen = int(context.args[0])
         except ValueError:
-            await context.bot.send_message(user.id, "Usage: /active [page]\nExample: /active 2 for page 2")
+            chosen = None
+        if chosen is None or not is_tracked(chosen):
+            await context.bot.send_message(user.id, "Usage: /chat [chat_id]\nConfigured chats: " + (", ".join(map(str, chat_ids())) or "none"))
             return
-    now = int(time.time())
-    days = 7
-    threshold = now - days * 86400
-    page_size = 50
-    offset = (page - 1) * page_size
+        context.user_data["chat_id"] = chosen
+    current = target_chat(update, context)
+    lines = [f"{'→' if c == current else '•'} {c}" for c in chat_ids()]
+    try:
+        await context.bot.send_message(user.id, f"Reports and lists use chat {current}.\n" + "\n".join(lines) + "\nSwitch with /chat <chat_id>.")
+    except Exception as e:
+        log.warning("Could not DM chat list to %s: %s", user.id, e)
+
+LISTING_PAGE_SIZE = 50
+LISTING_TTL = 600
+
+def _ints(value, n):
+    return isinstance(value, list) and len(value) == n and all(type(v) is int for v in value)
+
+def _parse_listing_args(args, kind, nparams=0, key_len=1):
+    """[params...] [page|token] -> (chat_id, params, page, cursor); the token carries its own chat and params."""
+    args = list(args or [])
+    if args and not args[-1].isdigit():
+        data = decode_cursor(args[-1])
+        # tokens come back from users: anything but the exact shape we issued is rejected
+        if not (isinstance(data, list) and len(data) == 5 and data[0] == kind and type(data[1]) is int and is_tracked(data[1])):
+            raise ValueError(args[-1])
+        _, chat_id, params, page, cursor = data
+        if not (_ints(params, nparams) and type(page) is int and page >= 1 and (cursor is None or _ints(cursor, key_len))):
+            raise ValueError(args[-1])
+        return chat_id, params, page, cursor
+    params = [max(1, int(a)) for a in args[:nparams]]
+    page = max(1, int(args[nparams])) if len(args) > nparams else 1
+    return None, params, page, None
+
+async def _listing_page(context, kind, chat_id, params, page, cursor, fetch, count, key_of=lambda row: [row["user_id"]]):
+    """Одна страница списка: курсоры и общее число кешируются на сессию листинга."""
+    sessions = context.user_data.setdefault("listings", {})
+    now = time.time()
+    for k in [k for k, v in sessions.items() if now - v["ts"] > LISTING_TTL]:
+        del sessions[k]
+    session = sessions.get((kind, chat_id, *params))
+    if session is None:
+        session = sessions[(kind, chat_id, *params)] = {"total": None, "cursors": {1: None}}
+    session["ts"] = now
+    if cursor is None:
+        cursor = session["cursors"].get(page)
+    if cursor is not None or page == 1:
+        rows = await fetch(LISTING_PAGE_SIZE, cursor, 0)
+    else:
+        # no token for this page yet: one offset scan, then keyset from here on
+        rows = await fetch(LISTING_PAGE_SIZE, None, (page - 1) * LISTING_PAGE_SIZE)
+    next_token = None
+    if len(rows) == LISTING_PAGE_SIZE:
+        next_key = key_of(rows[-1])
+        session["cursors"][page + 1] = next_key
+        next_token = encode_cursor([kind, chat_id, list(params), page + 1, next_key])
+    if session["total"] is None:
+        session["total"] = await count()
+    return rows, session["total"], next_token
+
+def _next_page_line(kind, token):
+    return f"\nДальше: `/{kind} {token}`" if token else ""
 
-    rows, total_active = await fetch_active_users(chat_id, threshold, page_size, offset)
-        
+@owners_only
+async def active_cmd(update, context):
+    user = update.effective_user
+    if not user:
+        return
+    # Parse arguments: page or next-page token
+    try:
+        chat_id, _, page, cursor = _parse_listing_args(context.args, "active")
+    except ValueError:
+        await context.bot.send_message(user.id, "Usage: /active [page]\nExample: /active 2 for page 2")
+        return
+    chat_id = chat_id or target_chat(update, context)
+    if not chat_id:
+        await context.bot.send_message(user.id, "chat_id not configured")
+        return
+    days = window_days()
+    threshold = active_since()
+    offset = (page - 1) * LISTING_PAGE_SIZE
+
+    async def count():
+        return active_count(chat_id)
+
+    rows, total_active, next_token = await _listing_page(
+        context, "active", chat_id, [], page, cursor,
+        lambda n, after, off: fetch_active_users(chat_id, threshold, n, after, off),
+        count,
+    )
     if not rows:
         await context.bot.send_message(user.id, f"Нет активных пользователей за последние {days} дней на странице {page}.")
         return
     # Filter users who are still in chat
-    active_users = []
-    for row in rows:
-        status = await check_chat_member_status(context, chat_id, row["user_id"])
-        await asyncio.sleep(0.1)  # Respect Telegram API rate limits # lol
-        if status not in ("left", "kicked"):
-            active_users.append(row)
+    active_users = await present_members(context, chat_id, rows)
     # Apply pagination display
     start_idx = offset + 1
     end_idx = min(offset + len(active_users), total_active)
@@ -265,7 +457,7 @@ async def active_cmd(update, context):
         name = f"@{row['username']}" if row["username"] else f"{row['first_name'] or ''} {row['last_name'] or ''}".strip() or "ㅤ"
         name_escaped = escape_md(name)
         lines.append(f"• {name_escaped}")
-    text = "\n".join(lines)
+    text = "\n".join(lines) + _next_page_line("active", next_token)
     try:
         await context.bot.send_message(user.id, text, parse_mode="Markdown")
     except Exception as e:
@@ -275,7 +467,7 @@ async def start(update, _):
     msg = (
         "I'm alive.\n"
         "1) Add me to your group and make me admin with 'ban users'.\n"
-        "2) Type /id in the group; copy the number into config.json as chat_id.\n"
+        "2) Type /id in the group; add the number to config.json as chat_id (or to the chats list for several groups).\n"
         "Channel scheduler: set channel_id in config.json, then use /schedule_day YYYY-MM-DD and send exactly 8 images.\n"
         f"Posts are jittered ±{CONFIG['schedule_jitter_min']} min for natural timing.\n\n"
         "Daily rules: I can post & pin rules every day at the configured time. Use /rules_now to test.\n"
@@ -289,45 +481,102 @@ async def id_cmd(update, _):
     if update.effective_message and chat:
         await update.effective_message.reply_text(f"Chat ID: {chat.id}")
 
+# Group messages message_tracker sees; their sender's profile rides along with the message item
+TRACKED_MESSAGES = filters.ChatType.GROUPS & (~filters.COMMAND)
+
 async def message_tracker(update, _):
     chat = update.effective_chat
     user = update.effective_user
     msg = update.effective_message
-    if not chat or chat.id != CONFIG["chat_id"]:
+    if not chat or not is_tracked(chat.id):
         return
     if not user or user.is_bot or not msg:
         return
     now = int(time.time())
-    await upsert_user(user, last_msg_ts=now)
     reply_to = msg.reply_to_message.message_id if getattr(msg, "reply_to_message", None) else None
     thread_id = getattr(msg, "message_thread_id", None)
-    try:
-        await insert_message(chat.id, msg.message_id, user.id, now, reply_to, thread_id)
-    except Exception as e:
-        log.warning("Failed to log message analytics: %s", e)
+    await enqueue_message(chat.id, user, msg.message_id, now, reply_to, thread_id)
+
+async def note_profiles(update, _):
+    """Обновляет профили и историю username всех пользователей, которых видим в апдейтах чата."""
+    chat = update.effective_chat
+    if not chat or not is_tracked(chat.id):
+        return
+    msg = update.effective_message
+    cmu = update.chat_member or update.my_chat_member
+    # left_members/chat_member_update handle departures; re-adding the profile would undo them
+    if msg and msg.left_chat_member:
+        return
+    if cmu and member_status(cmu.new_chat_member) in ("left", "kicked"):
+        return
+    sender = update.effective_user
+    # message_tracker will queue the sender with the message itself (bots and join notices excepted)
+    if sender and not sender.is_bot and msg and not msg.new_chat_members and TRACKED_MESSAGES.check_update(update):
+        sender = None
+    users = [sender]
+    if msg:
+        users.append(getattr(msg.reply_to_message, "from_user", None))
+        users.extend(msg.new_chat_members or ())
+    if cmu:
+        users.append(cmu.new_chat_member.user)
+    seen = set()
+    for u in users:
+        if u and u.id not in seen:
+            seen.add(u.id)
+            await enqueue_profile(chat.id, u)
+
+async def resolve_username(context, chat_id, username):
+    """@username -> ChatMember: кандидаты из локального индекса, API только подтверждает."""
+    for row in await find_users_by_username(chat_id, username):
+        try:
+            member = await context.bot.get_chat_member(chat_id, row["user_id"])
+        except BadRequest:
+            continue
+        # the username history is global: skip candidates who are not in this chat
+        if member_status(member) in ("left", "kicked"):
+            continue
+        if (member.user.username or "").lower() == username.lower():
+            return member
+        # the username has moved on; remember the fresh profile
+        await enqueue_profile(chat_id, member.user)
+    return None
 
 async def new_members(update, _):
     chat = update.effective_chat
     msg = update.effective_message
-    if not chat or chat.id != CONFIG["chat_id"]:
+    if not chat or not is_tracked(chat.id):
         return
     if not msg or not msg.new_chat_members:
         return
     now = int(time.time())
     for u in msg.new_chat_members:
-        await upsert_user(u, joined_ts=now)
+        await upsert_user(chat.id, u, joined_ts=now)
+    await update_member_statuses([(chat.id, u.id, ChatMember.MEMBER, now) for u in msg.new_chat_members])
 
 async def left_members(update, _):
     chat = update.effective_chat
     msg = update.effective_message
-    if not chat or chat.id != CONFIG["chat_id"]:
+    if not chat or not is_tracked(chat.id):
         return
     if not msg or not msg.left_chat_member:
         return
     user = msg.left_chat_member
-    await delete_user(user.id)
+    # through the ingest queue, behind any of their messages still buffered
+    await enqueue_delete(chat.id, user.id)
+    await update_member_statuses([(chat.id, user.id, ChatMember.LEFT, int(time.time()))])
     log.info(f"User {user.id} left the chat, removed from DB.")
 
+async def chat_member_update(update, _):
+    cmu = update.chat_member or update.my_chat_member
+    if not cmu or not is_tracked(cmu.chat.id):
+        return
+    member = cmu.new_chat_member
+    status = member_status(member)
+    now = int(time.time())
+    if status not in ("left", "kicked") and member_status(cmu.old_chat_member) in ("left", "kicked"):
+        await upsert_user(cmu.chat.id, member.user, joined_ts=now)
+    await update_member_statuses([(cmu.chat.id, member.user.id, status, now)])
+
 async def chill(update, context):
     MAX_MIN = 10080
     MIN_MIN = 1
@@ -336,7 +585,7 @@ async def chill(update, context):
     user = update.effective_user
     msg = update.effective_message
     
-    if not chat or chat.id != CONFIG["chat_id"] or not user or not msg:
+    if not chat or not is_tracked(chat.id) or not user or not msg:
         return
     if not context.args:
         await msg.reply_text("Usage: /chill <minutes>, e.g. /chill 30")
@@ -381,10 +630,10 @@ async def mute_cmd(update, context):
     chat = update.effective_chat
     msg = update.effective_message
     actor = update.effective_user
-    if not chat or chat.id != CONFIG.get("chat_id"):
+    if not chat or not is_tracked(chat.id):
         await msg.reply_text("Эта команда работает только в указанном чате.")
         return
-    if not actor or actor.id not in CONFIG.get("mute_admin_ids", []):
+    if not actor or actor.id not in chat_setting(chat.id, "mute_admin_ids", []):
         await msg.reply_text("Только администраторы могут использовать /mute.")
         return
     if not context.args:
@@ -401,27 +650,27 @@ async def mute_cmd(update, context):
     if minutes > 10080:
         minutes = 10080
     target_user = None
+    tmem = None
     if msg.reply_to_message and msg.reply_to_message.from_user:
         target_user = msg.reply_to_message.from_user
     elif context.args[0].startswith("@"):
         username = context.args[0][1:]
         try:
-            async for member in context.bot.get_chat_members(chat.id):
-                if member.user.username and member.user.username.lower() == f"@{username.lower()}":
-                    target_user = member.user
-                    break
-            if not target_user:
-                await msg.reply_text(f"Пользователь @{username} не найден в этом чате.")
-                return
+            tmem = await resolve_username(context, chat.id, username)
         except Exception as e:
             log.error(f"Ошибка при поиске пользователя @{username}: {e}")
-            await msg.reply_text("Не удалось найти пользователя. Убедитесь, что бот имеет доступ к списку участников.")
+            await msg.reply_text("Не удалось найти пользователя.")
+            return
+        if not tmem:
+            await msg.reply_text(f"Пользователь @{username} не найден в этом чате.")
             return
+        target_user = tmem.user
     else:
         await msg.reply_text("Использование: /mute <минуты> (в ответ на сообщение) или /mute @Username <минуты>")
         return
     try:
-        tmem = await context.bot.get_chat_member(chat.id, target_user.id)
+        if tmem is None:
+            tmem = await context.bot.get_chat_member(chat.id, target_user.id)
         if tmem.status in ("creator", "administrator"):
             await msg.reply_text("Нельзя замьютить администратора.")
             return
@@ -449,37 +698,37 @@ async def unmute_cmd(update, context):
     msg = update.effective_message
     actor = update.effective_user
     log.debug(f"Received /unmute from user {actor.id if actor else None} in chat {chat.id if chat else None}")
-    if not chat or chat.id != CONFIG.get("chat_id"):
+    if not chat or not is_tracked(chat.id):
         await msg.reply_text("Эта команда работает только в указанном чате.")
         return
-    if not actor or actor.id not in CONFIG.get("mute_admin_ids", []):
+    if not actor or actor.id not in chat_setting(chat.id, "mute_admin_ids", []):
         await msg.reply_text("Только администраторы могут использовать /unmute.")
         return
     if not context.args and not msg.reply_to_message:
         await msg.reply_text("Использование: /unmute (в ответ на сообщение) или /unmute @Username")
         return
     target_user = None
+    tmem = None
     if msg.reply_to_message and msg.reply_to_message.from_user:
         target_user = msg.reply_to_message.from_user
     elif context.args and context.args[0].startswith("@"):
         username = context.args[0][1:]
         try:
-            async for member in context.bot.get_chat_members(chat.id):
-                if member.user.username and member.user.username.lower() == f"@{username.lower()}":
-                    target_user = member.user
-                    break
-            if not target_user:
-                await msg.reply_text(f"Пользователь @{username} не найден в этом чате.")
-                return
+            tmem = await resolve_username(context, chat.id, username)
         except Exception as e:
             log.error(f"Ошибка при поиске пользователя @{username}: {e}")
-            await msg.reply_text("Не удалось найти пользователя. Убедитесь, что бот имеет доступ к списку участников.")
+            await msg.reply_text("Не удалось найти пользователя.")
+            return
+        if not tmem:
+            await msg.reply_text(f"Пользователь @{username} не найден в этом чате.")
             return
+        target_user = tmem.user
     else:
         await msg.reply_text("Использование: /unmute (в ответ на сообщение) или /unmute @Username")
         return
     try:
-        tmem = await context.bot.get_chat_member(chat.id, target_user.id)
+        if tmem is None:
+            tmem = await context.bot.get_chat_member(chat.id, target_user.id)
         if tmem.status in ("creator", "administrator"):
             await msg.reply_text("Нельзя размуть администратора (они не ограничены).")
             return
@@ -504,28 +753,26 @@ async def unmute_cmd(update, context):
 
 SCHED_PHOTOS = 1
 
-async def post_photo_job(context):
-    data = context.job.data or {}
-    sched_id = data.get("id")
-    if not sched_id:
-        return
-    # get scheduled_post
-    row = await fetch_scheduled_post(sched_id)
-    if not row or row["status"] != "pending":
-        return
-    try:
-        await context.bot.send_photo(
-            chat_id=row["channel_id"],
-            photo=row["file_id"],
-            caption=row["caption"] or None,
-        )
+async def send_scheduled_post(bot, row):
+    # goes through the channel's token bucket, so a catch-up burst stays under flood limits
+    await api.call(
+        row["channel_id"],
+        bot.send_photo,
+        chat_id=row["channel_id"],
+        photo=row["file_id"],
+        caption=row["caption"] or None,
+    )
 
-        #set post as sent 
-        await change_scheduled_post_status(sched_id, "sent", int(time.time())),
-        log.info("Posted scheduled photo id=%s", sched_id)
-    except Exception as e:
-        await change_scheduled_post_status(sched_id, "failed", int(time.time())),
-        log.error("Failed to post scheduled photo id=%s: %s", sched_id, e)
+SCHED_MAX_DAYS = 62
+
+def schedule_slots(days, start, gap_min, per_day, jitter_min, tz):
+    """Local datetimes: per_day posts a day from `start` every gap_min minutes, each jittered ±jitter_min."""
+    slots = []
+    for day in days:
+        first = datetime.combine(day, start, tz)
+        for i in range(per_day):
+            slots.append(first + timedelta(minutes=gap_min * i + random.randint(-jitter_min, jitter_min)))
+    return slots
 
 @requires_auth
 async def schedule_day(update, context):
@@ -543,7 +790,7 @@ async def schedule_day(update, context):
     except ValueError:
         await msg.reply_text("Date must be in YYYY-MM-DD format, e.g. 2025-09-20")
         return ConversationHandler.END
-    context.user_data["schedule_date"] = target_date
+    context.user_data["schedule_plan"] = {"days": [target_date], "start": dtime(hour=12, minute=30), "gap": 90, "per_day": 8}
     context.user_data["photos"] = []
     await msg.reply_text(
         f"Got it. Now send exactly 8 images (as an album or one-by-one). "
@@ -552,6 +799,46 @@ async def schedule_day(update, context):
     )
     return SCHED_PHOTOS
 
+@requires_auth
+async def schedule_range(update, context):
+    msg = update.effective_message
+    if CONFIG.get("channel_id", 0) == 0:
+        await msg.reply_text(
+            "Set channel_id in config.json (make the bot an admin of that channel), then try again."
+        )
+        return ConversationHandler.END
+    usage = (
+        "Usage: /schedule_range FROM TO [HH:MM] [gap_min] [per_day]\n"
+        "Example: /schedule_range 2025-10-01 2025-10-31 12:30 90 8"
+    )
+    args = context.args or []
+    if len(args) < 2:
+        await msg.reply_text(usage)
+        return ConversationHandler.END
+    try:
+        first_day = datetime.strptime(args[0], "%Y-%m-%d").date()
+        last_day = datetime.strptime(args[1], "%Y-%m-%d").date()
+        start = datetime.strptime(args[2], "%H:%M").time() if len(args) > 2 else dtime(hour=12, minute=30)
+        gap = int(args[3]) if len(args) > 3 else 90
+        per_day = int(args[4]) if len(args) > 4 else 8
+    except ValueError:
+        await msg.reply_text(usage)
+        return ConversationHandler.END
+    n_days = (last_day - first_day).days + 1
+    if not 1 <= n_days <= SCHED_MAX_DAYS or gap < 1 or not 1 <= per_day <= 24:
+        await msg.reply_text(f"The range must cover 1–{SCHED_MAX_DAYS} days, with gap ≥ 1 min and 1–24 posts per day.")
+        return ConversationHandler.END
+    days = [first_day + timedelta(days=i) for i in range(n_days)]
+    context.user_data["schedule_plan"] = {"days": days, "start": start, "gap": gap, "per_day": per_day}
+    context.user_data["photos"] = []
+    await msg.reply_text(
+        f"Got it: {n_days} days × {per_day} slots, starting {start.strftime('%H:%M')} every {gap} min "
+        f"(each jittered ±{CONFIG['schedule_jitter_min']} min). "
+        f"Send up to {n_days * per_day} images, then /done — slots are filled in order. "
+        f"Send /cancel to abort."
+    )
+    return SCHED_PHOTOS
+
 @requires_auth
 async def schedule_collect_photo(update, context):
     msg = update.effective_message
@@ -564,48 +851,61 @@ async def schedule_collect_photo(update, context):
         file_id = msg.document.file_id
     if not file_id:
         return SCHED_PHOTOS
+    plan = context.user_data.get("schedule_plan")
+    if not plan:
+        return ConversationHandler.END
+    capacity = len(plan["days"]) * plan["per_day"]
     photos = context.user_data.get("photos", [])
-    if len(photos) >= 8:
+    if len(photos) >= capacity:
         return SCHED_PHOTOS
     photos.append(file_id)
     context.user_data["photos"] = photos
-    if len(photos) < 8:
-        await msg.reply_text(f"Saved {len(photos)}/8. Keep them coming…")
+    if len(photos) < capacity:
+        await msg.reply_text(f"Saved {len(photos)}/{capacity}. Keep them coming…")
+        return SCHED_PHOTOS
+    return await _schedule_commit(msg, context)
+
+@requires_auth
+async def schedule_done(update, context):
+    msg = update.effective_message
+    if not context.user_data.get("schedule_plan") or not context.user_data.get("photos"):
+        await msg.reply_text("No images yet. Send some, or /cancel.")
         return SCHED_PHOTOS
-    target_date = context.user_data["schedule_date"]
+    return await _schedule_commit(msg, context)
+
+async def _schedule_commit(msg, context):
+    plan = context.user_data["schedule_plan"]
+    photos = context.user_data["photos"]
     tz = timezone_()
-    start_local = datetime.combine(target_date, dtime(hour=12, minute=30), tz)
-    scheduled_times_local = [start_local + timedelta(minutes=90 * i) for i in range(8)]
     jitter = int(CONFIG.get("schedule_jitter_min", 15))
-    scheduled_times_local = [dt + timedelta(minutes=random.randint(-jitter, jitter)) for dt in scheduled_times_local]
-    jq = get_job_queue(context.application)
-    if jq is None:
-        await msg.reply_text("Scheduling failed: JobQueue not available on this bot instance.")
-        return ConversationHandler.END
-    ids = []
-    for _, (fid, run_local) in enumerate(zip(photos, scheduled_times_local)):
-        run_utc = run_local.astimezone(timezone.utc)
-        sched_id = await add_scheduled_post(fid, run_utc, CONFIG["channel_id"])
-        ids.append(sched_id)
-        jq.run_once(
-            post_photo_job,
-            when=run_utc,
-            data={"id": sched_id},
-            name=f"post-{sched_id}",
+    slots = schedule_slots(plan["days"], plan["start"], plan["gap"], plan["per_day"], jitter, tz)[:len(photos)]
+    await add_scheduled_posts([
+        (fid, run_local.astimezone(timezone.utc), CONFIG["channel_id"])
+        for fid, run_local in zip(photos, slots)
+    ])
+    notify_scheduled()
+    if len(slots) <= 24:
+        human = "\n".join(dt.strftime("• %H:%M on %Y-%m-%d") for dt in slots)
+    else:
+        # a month of slots would not fit in one message; summarize per day
+        by_day = {}
+        for dt in slots:
+            by_day.setdefault(dt.date(), []).append(dt)
+        human = "\n".join(
+            f"• {day:%Y-%m-%d}: {len(ts)} posts, {min(ts):%H:%M}–{max(ts):%H:%M}" for day, ts in by_day.items()
         )
-    human = "\n".join(dt.strftime("• %H:%M on %Y-%m-%d") for dt in scheduled_times_local)
     await msg.reply_text(
-        "Scheduled 8 posts to channel_id="
+        f"Scheduled {len(slots)} posts to channel_id="
         f"{CONFIG['channel_id']} ({CONFIG.get('tz')}).\n" + human
     )
     context.user_data.pop("photos", None)
-    context.user_data.pop("schedule_date", None)
+    context.user_data.pop("schedule_plan", None)
     return ConversationHandler.END
 
 @requires_auth
 async def schedule_cancel(update, context):
     context.user_data.pop("photos", None)
-    context.user_data.pop("schedule_date", None)
+    context.user_data.pop("schedule_plan", None)
     if update.effective_message:
         await update.effective_message.reply_text("Scheduling cancelled.")
     return ConversationHandler.END
@@ -625,12 +925,13 @@ async def schedule_list(update, _):
         lines.append(f"• #{r['id']} — {dt_local.strftime('%H:%M on %Y-%m-%d')}")
     await msg.reply_text("Pending scheduled posts:\n" + "\n".join(lines))
 
-async def post_and_pin_rules(context):
-    chat_id = CONFIG.get("chat_id")
+async def post_and_pin_rules(context, chat_id = None):
+    # the daily job carries its chat in job.data
+    chat_id = chat_id or (context.job.data if context.job else None) or CONFIG.get("chat_id")
     if not chat_id:
         log.info("Rules post skipped: chat_id not set in config.json")
         return
-    text = get_rules_text()
+    text = get_rules_text(chat_id)
     if not text.strip():
         log.info("Rules post skipped: rules text empty")
         return
@@ -646,68 +947,88 @@ async def post_and_pin_rules(context):
 
 @requires_auth
 async def rules_now(update, context):
-    await post_and_pin_rules(context)
+    chat = update.effective_chat
+    await post_and_pin_rules(context, chat.id if chat and is_tracked(chat.id) else None)
     if update.effective_message:
         await update.effective_message.reply_text("Rules posted (and pinned if possible).")
 
+def member_status(member):
+    """Статус участника; ограниченный пользователь, покинувший чат, считается 'left'."""
+    if isinstance(member, ChatMemberRestricted) and not member.is_member:
+        return ChatMember.LEFT
+    return member.status
+
 async def check_chat_member_status(context, chat_id, user_id):
     """Проверяет статус пользователя в чате через Telegram API."""
     try:
         member = await context.bot.get_chat_member(chat_id, user_id)
-        return member.status  # 'member', 'administrator', 'left', 'kicked', etc.
+        return member_status(member)  # 'member', 'administrator', 'left', 'kicked', etc.
     except BadRequest:
         return "left"  # Пользователь не в чате
 
+async def present_members(context, chat_id, rows):
+    """Оставляет только тех, кто ещё в чате, по локальной копии членства (таблица members).
+
+    Пользователей, которых копия ещё не видела, один раз проверяем через API и запоминаем.
+    """
+    unknown = [row["user_id"] for row in rows if row["member_status"] is None]
+    statuses = {}
+    if unknown:
+        now = int(time.time())
+        # reads only count against the global bucket; the per-chat ~20/min limit is for sending messages
+        results = await api.map(None, lambda uid: check_chat_member_status(context, chat_id, uid), unknown)
+        for user_id, status in zip(unknown, results):
+            if isinstance(status, Exception):
+                log.warning("Could not check membership of %s: %s", user_id, status)
+                continue
+            statuses[user_id] = status
+        await update_member_statuses([(chat_id, uid, st, now) for uid, st in statuses.items()])
+    return [row for row in rows if statuses.get(row["user_id"], row["member_status"]) not in ("left", "kicked")]
+
 @owners_only
 async def inactive_cmd(update, context):
     user = update.effective_user
     if not user:
         return
-    chat_id = CONFIG.get("chat_id")
+    # Parse arguments: days and optional page, or a next-page token
+    try:
+        chat_id, params, page, cursor = _parse_listing_args(context.args, "inactive", 1, key_len=2)
+    except ValueError:
+        await context.bot.send_message(user.id, "Usage: /inactive [days] [page]\nExample: /inactive 14 2 for 14 days inactivity, page 2")
+        return
+    chat_id = chat_id or target_chat(update, context)
     if not chat_id:
         await context.bot.send_message(user.id, "chat_id not configured")
         return
-    # Parse arguments: days and optional page
-    days = CONFIG.get("inactivity_days", 7)
-    page = 1
-    if context.args:
-        try:
-            days = max(1, int(context.args[0]))
-            if len(context.args) > 1:
-                page = max(1, int(context.args[1]))
-        except ValueError:
-            await context.bot.send_message(user.id, "Usage: /inactive [days] [page]\nExample: /inactive 14 2 for 14 days inactivity, page 2")
-            return
+    days = params[0] if params else chat_setting(chat_id, "inactivity_days", 7)
     now = int(time.time())
-    # Set reference date to 2 September 2025 (chat creation date)
-    reference_date = int(datetime(2025, 9, 2, tzinfo=timezone.utc).timestamp())
+    # Reference date: when the chat was created (users who never wrote count from there)
+    ref = date.fromisoformat(chat_setting(chat_id, "reference_date", "2025-09-02"))
+    reference_date = int(datetime(ref.year, ref.month, ref.day, tzinfo=timezone.utc).timestamp())
+    ref_str = f"{ref.day} {months_ru.get(ref.strftime('%B'), ref.strftime('%B'))} {ref.year}"
     threshold = now - days * 86400
-    page_size = 50
-    offset = (page - 1) * page_size
+    offset = (page - 1) * LISTING_PAGE_SIZE
 
-    rows = await fetch_inactive_users(threshold, reference_date)
+    rows, total_inactive, next_token = await _listing_page(
+        context, "inactive", chat_id, [days], page, cursor,
+        lambda n, after, off: fetch_inactive_users(chat_id, threshold, reference_date, n, after, off),
+        lambda: count_inactive_users(chat_id, threshold, reference_date),
+        key_of=lambda row: [row["sort_ts"], row["user_id"]],
+    )
     if not rows:
         await context.bot.send_message(user.id, f"Нет неактивных пользователей (≥{days}д без сообщений) на странице {page}.")
         return
     # Filter users who are still in chat (exclude left/kicked)
-    active_users = []
-    for row in rows:
-        status = await check_chat_member_status(context, chat_id, row["user_id"])
-        await asyncio.sleep(0.1)  # Delay to respect Telegram API rate limits
-        if status not in ("left", "kicked"):
-            active_users.append(row)
-    # Apply pagination
-    paginated_users = active_users[offset:offset + page_size]
-    total_active = len(active_users)
-    if not paginated_users:
-        await context.bot.send_message(user.id, f"Нет неактивных пользователей (≥{days}д без сообщений) на странице {page}, которые всё ещё в чате.")
+    inactive_users = await present_members(context, chat_id, rows)
+    if not inactive_users:
+        await context.bot.send_message(user.id, f"Нет неактивных пользователей (≥{days}д без сообщений) на странице {page}, которые всё ещё в чате." + _next_page_line("inactive", next_token), parse_mode="Markdown")
         return
     # Calculate pagination display
     start_idx = offset + 1
-    end_idx = min(offset + len(paginated_users), total_active)
-    lines = [f"Неактивные (≥{days}д с 2 сентября 2025) — режим: по сообщениям\nНайдено: {total_active} — показываю {start_idx}–{end_idx}"]
-    tz = timezone_()
-    for row in paginated_users:
+    end_idx = min(offset + len(inactive_users), total_inactive)
+    lines = [f"Неактивные (≥{days}д с {ref_str}) — режим: по сообщениям\nНайдено: {total_inactive} — показываю {start_idx}–{end_idx}"]
+    tz = timezone_(chat_id)
+    for row in inactive_users:
         if row["last_msg_ts"] is not None:
             ts = row["last_msg_ts"]
             days_inactive = (now - ts) // 86400
@@ -715,7 +1036,7 @@ async def inactive_cmd(update, context):
             date_str = f"{dt.day} {months_ru.get(dt.strftime('%B'), dt.strftime('%B'))} {dt.year}"
             inactive_text = f"{days_inactive}д (с {date_str})"
         else:
-            # For users without messages, use joined_ts or reference date (2 Sep 2025)
+            # For users without messages, use joined_ts or the reference date
             ts = row["joined_ts"] if row["joined_ts"] is not None else reference_date
             days_inactive = (now - ts) // 86400
             dt = localize(ts, tz)
@@ -729,65 +1050,41 @@ async def inactive_cmd(update, context):
                 name = "ㅤ ㅤ"
         name_escaped = escape_md(name)
         lines.append(f"• {name_escaped} — {inactive_text}")
-    text = "\n".join(lines)
+    text = "\n".join(lines) + _next_page_line("inactive", next_token)
     try:
         await context.bot.send_message(user.id, text, parse_mode="Markdown")
     except Exception as e:
         log.warning("Could not DM inactive list to %s: %s", user.id, e)
 
-async def _reload_scheduled_posts(app):
-    
-    now_utc = datetime.now(timezone.utc)
-    jq = get_job_queue(app)
-    if jq is None:
-        log.error("Cannot reschedule posts: JobQueue missing.")
-        return
-    
-    rows = await fetch_all_scheduled_posts()
-    for row in rows:
-        run_at_utc = datetime.fromtimestamp(row["run_at_ts"], tz=timezone.utc)
-        if run_at_utc <= now_utc:
-            continue
-        jq.run_once(
-            post_photo_job,
-            when=run_at_utc,
-            data={"id": row["id"]},
-            name=f"post-{row['id']}",
-        )
-
 @owners_only
 async def allmembers_cmd(update, context):
     user = update.effective_user
     if not user:
         return
-    chat_id = CONFIG.get("chat_id")
+    # Parse arguments: page or next-page token
+    try:
+        chat_id, _, page, cursor = _parse_listing_args(context.args, "allmembers")
+    except ValueError:
+        await context.bot.send_message(user.id, "Usage: /allmembers [page]\nExample: /allmembers 2 for page 2")
+        return
+    chat_id = chat_id or target_chat(update, context)
     if not chat_id:
         await context.bot.send_message(user.id, "chat_id not configured")
         return
-    # Parse arguments: page
-    page = 1
-    if context.args:
-        try:
-            page = max(1, int(context.args[0]))
-        except ValueError:
-            await context.bot.send_message(user.id, "Usage: /allmembers [page]\nExample: /allmembers 2 for page 2")
-            return
-    page_size = 50
-    offset = (page - 1) * page_size
+    offset = (page - 1) * LISTING_PAGE_SIZE
 
     # Fetch all users from activity table
-    rows, total_users = await fetch_all_users(page_size, offset)
+    rows, total_users, next_token = await _listing_page(
+        context, "allmembers", chat_id, [], page, cursor,
+        lambda n, after, off: fetch_all_users(chat_id, n, after, off),
+        lambda: count_all_users(chat_id),
+    )
     if not rows:
         await context.bot.send_message(user.id, f"Нет пользователей на странице {page}.")
         return
     
     # Filter users who are still in chat
-    active_users = []
-    for row in rows:
-        status = await check_chat_member_status(context, chat_id, row["user_id"])
-        await asyncio.sleep(0.1)  # Respect Telegram API rate limits
-        if status not in ("left", "kicked"):
-            active_users.append(row)
+    active_users = await present_members(context, chat_id, rows)
     
     # Apply pagination display
     start_idx = offset + 1
@@ -797,7 +1094,7 @@ async def allmembers_cmd(update, context):
         name = f"@{row['username']}" if row["username"] else f"{row['first_name'] or ''} {row['last_name'] or ''}".strip() or "ㅤ"
         name_escaped = escape_md(name)
         lines.append(f"• {name_escaped}")
-    text = "\n".join(lines)
+    text = "\n".join(lines) + _next_page_line("allmembers", next_token)
     try:
         await context.bot.send_message(user.id, text, parse_mode="Markdown")
     except Exception as e:
@@ -808,37 +1105,35 @@ async def silent_cmd(update, context):
     user = update.effective_user
     if not user:
         return
-    chat_id = CONFIG.get("chat_id")
+    # Parse arguments: page or next-page token
+    try:
+        chat_id, _, page, cursor = _parse_listing_args(context.args, "silent")
+    except ValueError:
+        await context.bot.send_message(user.id, "Usage: /silent [page]\nExample: /silent 2 for page 2")
+        return
+    chat_id = chat_id or target_chat(update, context)
     if not chat_id:
         await context.bot.send_message(user.id, "chat_id not configured")
         return
-    # Parse arguments: page
-    page = 1
-    if context.args:
-        try:
-            page = max(1, int(context.args[0]))
-        except ValueError:
-            await context.bot.send_message(user.id, "Usage: /silent [page]\nExample: /silent 2 for page 2")
-            return
     
-    now = int(time.time())
-    days = 7
-    threshold = now - days * 86400
-    page_size = 50
-    offset = (page - 1) * page_size
+    days = window_days()
+    threshold = active_since()
+    offset = (page - 1) * LISTING_PAGE_SIZE
 
-    rows, total_silent = await fetch_inactive_users(chat_id, threshold, page_size, offset),
+    async def count():
+        return max(0, await count_all_users(chat_id) - active_count(chat_id))
+
+    rows, total_silent, next_token = await _listing_page(
+        context, "silent", chat_id, [], page, cursor,
+        lambda n, after, off: fetch_silent_users(chat_id, threshold, n, after, off),
+        count,
+    )
     if not rows:
         await context.bot.send_message(user.id, f"Нет неактивных пользователей за последние {days} дней на странице {page}.")
         return
     
     # Filter users who are still in chat
-    silent_users = []
-    for row in rows:
-        status = await check_chat_member_status(context, chat_id, row["user_id"])
-        await asyncio.sleep(0.1)  # Respect Telegram API rate limits
-        if status not in ("left", "kicked"):
-            silent_users.append(row)
+    silent_users = await present_members(context, chat_id, rows)
     
     # Apply pagination display
     start_idx = offset + 1
@@ -848,7 +1143,7 @@ async def silent_cmd(update, context):
         name = f"@{row['username']}" if row["username"] else f"{row['first_name'] or ''} {row['last_name'] or ''}".strip() or "ㅤ"
         name_escaped = escape_md(name)
         lines.append(f"• {name_escaped}")
-    text = "\n".join(lines)
+    text = "\n".join(lines) + _next_page_line("silent", next_token)
     try:
         await context.bot.send_message(user.id, text, parse_mode="Markdown")
     except Exception as e:
@@ -856,76 +1151,137 @@ async def silent_cmd(update, context):
 
 async def on_startup(app: Application):
     try:
-        await init_db()
+        await init_db(readers=CONFIG.get("db_readers", 3), legacy_chat_id=CONFIG.get("chat_id"))
         log.info("Database initialized successfully")
     except Exception as e:
         log.error("Failed to initialize database: %s", e)
         raise
+    for chat_id in chat_ids():
+        # the offset table takes a few tens of ms; build it before the first flush needs it
+        tz_table(timezone_(chat_id))
+        if await rollups_need_backfill(chat_id):
+            await backfill_rollups(chat_id)
+    await load_active(chat_ids(), CONFIG.get("active_window_days", 7))
+    await start_ingest(
+        flush_ms=CONFIG.get("ingest_flush_ms", 500),
+        flush_rows=CONFIG.get("ingest_flush_rows", 200),
+        max_queue=CONFIG.get("ingest_queue_size", 5000),
+    )
+    if CONFIG.get("channel_id"):
+        api.set_chat_rate(CONFIG["channel_id"], CONFIG.get("channel_posts_per_min", 20) / 60)
+    max_age = CONFIG.get("schedule_catchup_max_age_min", 360) * 60
+    await catch_up(max_age=max_age, spread=CONFIG.get("schedule_catchup_spread_min", 0) * 60)
+    await start_dispatcher(
+        lambda row: send_scheduled_post(app.bot, row),
+        batch=CONFIG.get("schedule_batch_size", 20),
+        max_age=max_age,
+    )
     jq = get_job_queue(app)
     if jq is None:
         log.error("JobQueue not available, cannot schedule jobs")
         return
-    await _reload_scheduled_posts(app)
-    hh, mm = parse_hhmm(CONFIG.get("rules_time", "06:00"))
-    jq.run_daily(
-        post_and_pin_rules,
-        time=dtime(hour=hh, minute=mm, tzinfo=rules_timezone()),
-        name="daily-rules",
+    jq.run_repeating(
+        flush_metrics_job,
+        interval=CONFIG.get("metrics_flush_sec", 60),
+        first=CONFIG.get("metrics_flush_sec", 60),
+        name="metrics-flush",
+    )
+    jq.run_repeating(
+        sweep_active_job,
+        interval=CONFIG.get("active_sweep_sec", 300),
+        first=CONFIG.get("active_sweep_sec", 300),
+        name="active-sweep",
     )
+    if any(chat_setting(chat_id, "retention_days") for chat_id in chat_ids()):
+        hh, mm = parse_hhmm(CONFIG.get("retention_time", "04:00"))
+        jq.run_daily(retention_job, time=dtime(hour=hh, minute=mm, tzinfo=timezone_()), name="retention")
+    for chat_id in chat_ids():
+        hh, mm = parse_hhmm(chat_setting(chat_id, "rules_time", "06:00"))
+        jq.run_daily(
+            post_and_pin_rules,
+            time=dtime(hour=hh, minute=mm, tzinfo=rules_timezone(chat_id)),
+            data=chat_id,
+            name=f"daily-rules:{chat_id}",
+        )
     log.info(
-        "Bot started. Watching chat_id=%s. Channel_id=%s. TZ=%s. Rules at %s %s",
-        CONFIG["chat_id"],
+        "Bot started. Watching chats=%s. Channel_id=%s. TZ=%s. Rules at %s %s",
+        chat_ids(),
         CONFIG.get("channel_id"),
         CONFIG.get("tz"),
         CONFIG.get("rules_time"),
         CONFIG.get("rules_tz"),
     )
 
+async def on_shutdown(app: Application):
+    await stop_dispatcher()
+    await stop_ingest()
+    await flush_metrics(CONFIG.get("metrics_dump_path"))
+    await close_db()
+    log.info("Database connections closed")
+
 def main():
-    application = Application.builder().token(CONFIG["token"]).post_init(on_startup).build()
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("id", id_cmd))
-    application.add_handler(CommandHandler("chill", chill))
-    application.add_handler(CommandHandler("retreat", chill))
-    application.add_handler(CommandHandler("rules_now", rules_now))
-    application.add_handler(CommandHandler("schedule_list", schedule_list))
-    application.add_handler(CommandHandler("metrics", metrics_cmd))
-    application.add_handler(CommandHandler("heatmap", heatmap_cmd))
-    application.add_handler(CommandHandler("leaders", leaders_cmd))
-    application.add_handler(CommandHandler("streaks", streaks_cmd))
-    application.add_handler(CommandHandler("mute", mute_cmd))
-    application.add_handler(CommandHandler("unmute", unmute_cmd))
-    application.add_handler(CommandHandler("inactive", inactive_cmd))
-    application.add_handler(CommandHandler("active", active_cmd))
-    application.add_handler(CommandHandler("allmembers", allmembers_cmd))
-    application.add_handler(CommandHandler("silent", silent_cmd))
+    application = (
+        Application.builder()
+        .token(CONFIG["token"])
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    application.add_handler(TypeHandler(Update, timed("handler")(note_profiles)), group=-1)
+    application.add_handler(CommandHandler("start", timed("handler")(start)))
+    application.add_handler(CommandHandler("id", timed("handler")(id_cmd)))
+    application.add_handler(CommandHandler("chill", timed("handler")(chill)))
+    application.add_handler(CommandHandler("retreat", timed("handler")(chill)))
+    application.add_handler(CommandHandler("rules_now", timed("handler")(rules_now)))
+    application.add_handler(CommandHandler("schedule_list", timed("handler")(schedule_list)))
+    application.add_handler(CommandHandler("metrics", timed("handler")(metrics_cmd)))
+    application.add_handler(CommandHandler("heatmap", timed("handler")(heatmap_cmd)))
+    application.add_handler(CommandHandler("leaders", timed("handler")(leaders_cmd)))
+    application.add_handler(CommandHandler("streaks", timed("handler")(streaks_cmd)))
+    application.add_handler(CommandHandler("replytime", timed("handler")(replytime_cmd)))
+    application.add_handler(CommandHandler("latency", timed("handler")(latency_cmd)))
+    application.add_handler(CommandHandler("backfill_rollups", timed("handler")(backfill_cmd)))
+    application.add_handler(CommandHandler("chat", timed("handler")(chat_cmd)))
+    application.add_handler(CommandHandler("vacuum_setup", timed("handler")(vacuum_setup_cmd)))
+    application.add_handler(CommandHandler("mute", timed("handler")(mute_cmd)))
+    application.add_handler(CommandHandler("unmute", timed("handler")(unmute_cmd)))
+    application.add_handler(CommandHandler("inactive", timed("handler")(inactive_cmd)))
+    application.add_handler(CommandHandler("active", timed("handler")(active_cmd)))
+    application.add_handler(CommandHandler("allmembers", timed("handler")(allmembers_cmd)))
+    application.add_handler(CommandHandler("silent", timed("handler")(silent_cmd)))
     conv = ConversationHandler(
-        entry_points=[CommandHandler("schedule_day", schedule_day)],
+        entry_points=[
+            CommandHandler("schedule_day", timed("handler")(schedule_day)),
+            CommandHandler("schedule_range", timed("handler")(schedule_range)),
+        ],
         states={
             SCHED_PHOTOS: [
-                MessageHandler(filters.PHOTO | filters.Document.IMAGE, schedule_collect_photo),
-                CommandHandler("cancel", schedule_cancel),
+                MessageHandler(filters.PHOTO | filters.Document.IMAGE, timed("handler")(schedule_collect_photo)),
+                CommandHandler("done", timed("handler")(schedule_done)),
+                CommandHandler("cancel", timed("handler")(schedule_cancel)),
             ]
         },
-        fallbacks=[CommandHandler("cancel", schedule_cancel)],
+        fallbacks=[CommandHandler("cancel", timed("handler")(schedule_cancel))],
     )
     application.add_handler(conv)
+    application.add_handler(ChatMemberHandler(timed("handler")(chat_member_update), ChatMemberHandler.ANY_CHAT_MEMBER))
     application.add_handler(
         MessageHandler(
             filters.ChatType.GROUPS & filters.StatusUpdate.NEW_CHAT_MEMBERS,
-            new_members,
+            timed("handler")(new_members),
         )
     )
     application.add_handler(
         MessageHandler(
             filters.ChatType.GROUPS & filters.StatusUpdate.LEFT_CHAT_MEMBER,
-            left_members,
+            timed("handler")(left_members),
         )
     )
     application.add_handler(
         MessageHandler(
-            filters.ChatType.GROUPS & (~filters.COMMAND),
-            message_tracker,
+            TRACKED_MESSAGES,
+            timed("handler")(message_tracker),
         )
     )
     application.run_polling(allowed_updates=["message", "chat_member", "my_chat_member"])
@@ -0,0 +1,82 @@
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from config import CONFIG
+
+class ReportCache:
+    """LRU/TTL cache for rendered report text.
+
+    Keys carry a time bucket, so rolling windows move on by themselves.
+    Ingestion bumps the generation of each chat it wrote to; an entry
+    computed before the bump is still served for `grace` seconds, so a busy
+    chat does not defeat the cache, and after that it is recomputed. A busy
+    chat never expires another chat's reports.
+    """
+
+    def __init__(self, maxsize = 64, ttl = 600, grace = 60, bucket = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.grace = grace
+        self.bucket = max(1, bucket)
+        self.epoch = 0
+        self._generations = {}
+        self._entries = OrderedDict()
+
+    def generation(self, chat_id):
+        return self.epoch, self._generations.get(chat_id, 0)
+
+    def invalidate(self, chat_id = None):
+        """Bump one chat's generation, or every chat's without chat_id."""
+        if chat_id is None:
+            self.epoch += 1
+        else:
+            self._generations[chat_id] = self._generations.get(chat_id, 0) + 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def key(self, name, args, kwargs, now):
+        return (name, args, tuple(sorted(kwargs.items())), int(now // self.bucket))
+
+    def get(self, key, now, chat_id):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, created, generation = entry
+        age = now - created
+        if age >= self.ttl or (generation != self.generation(chat_id) and age >= self.grace):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, now, chat_id):
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = (value, now, self.generation(chat_id))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+report_cache = ReportCache(
+    maxsize=CONFIG.get("report_cache_size", 64),
+    ttl=CONFIG.get("report_cache_ttl_sec", 600),
+    grace=CONFIG.get("report_cache_grace_sec", 60),
+    bucket=CONFIG.get("report_cache_bucket_sec", 300),
+)
+
+def cached_report(name):
+    """Cache a report whose first argument is the chat_id it reports on."""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(chat_id, *args, **kwargs):
+            now = time.time()
+            key = report_cache.key(name, (chat_id,) + args, kwargs, now)
+            text = report_cache.get(key, now, chat_id)
+            if text is None:
+                text = await func(chat_id, *args, **kwargs)
+                report_cache.put(key, text, now, chat_id)
+            return text
+        return wrapper
+    return decorator
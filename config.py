@@ -1,8 +1,9 @@
 import json
+import os
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent
-CONFIG_PATH = BASE_DIR / "config.json"
+CONFIG_PATH = Path(os.environ.get("ROTKOBOT_CONFIG") or BASE_DIR / "config.json")
 
 def load_config():
     with open(CONFIG_PATH, "r", encoding="utf-8") as f:
@@ -10,16 +11,32 @@ def load_config():
     if "token" not in cfg or not cfg["token"]:
         raise RuntimeError("Please put your bot token into config.json under the 'token' key.")
     cfg.setdefault("chat_id", 0)
+    # Groups the bot watches. Each entry needs chat_id and may override
+    # per-chat settings (tz, inactivity_days, retention_days, rules_*,
+    # mute_admin_ids, reference_date); anything else comes from the top level.
+    cfg.setdefault("chats", [])
+    if not cfg["chats"] and cfg["chat_id"]:
+        cfg["chats"] = [{"chat_id": cfg["chat_id"]}]
+    if cfg["chats"] and not cfg["chat_id"]:
+        # the default chat for reports requested in a private chat
+        cfg["chat_id"] = cfg["chats"][0]["chat_id"]
     cfg.setdefault("inactivity_days", 7)
+    cfg.setdefault("active_window_days", 7)
+    cfg.setdefault("active_sweep_sec", 300)
     cfg.setdefault("check_interval_hours", 12)
     cfg.setdefault("soft_kick", True)
     cfg.setdefault("channel_id", 0)
     cfg.setdefault("tz", "Europe/Moscow")
     cfg.setdefault("schedule_jitter_min", 15)
+    cfg.setdefault("schedule_batch_size", 20)
+    cfg.setdefault("schedule_catchup_max_age_min", 360)
+    cfg.setdefault("schedule_catchup_spread_min", 0)
+    cfg.setdefault("channel_posts_per_min", 20)
     cfg.setdefault("allowed_user_ids", [])
     cfg.setdefault("rules_tz", "Europe/Moscow")
     cfg.setdefault("rules_time", "06:00")
     cfg.setdefault("rules_message_file", "rules.txt")
+    cfg.setdefault("reference_date", "2025-09-02")
     cfg.setdefault(
         "rules_message",
         (
@@ -35,6 +52,25 @@ def load_config():
     )
     cfg.setdefault("metrics_owner_ids", [])
     cfg.setdefault("metrics_dump_path", "private_metrics.ndjson")
+    cfg.setdefault("metrics_flush_sec", 60)
+    cfg.setdefault("db_readers", 3)
+    cfg.setdefault("retention_days", 0)
+    cfg.setdefault("retention_batch_rows", 2000)
+    cfg.setdefault("retention_time", "04:00")
+    cfg.setdefault("ingest_flush_ms", 500)
+    cfg.setdefault("ingest_flush_rows", 200)
+    cfg.setdefault("ingest_queue_size", 5000)
+    cfg.setdefault("api_concurrency", 8)
+    cfg.setdefault("api_rate_per_sec", 30)
+    cfg.setdefault("api_chat_rate_per_sec", 20 / 60)  # Telegram allows about 20 messages a minute per group
+    cfg.setdefault("analytics_backend", "sqlite")
+    cfg.setdefault("report_cache_size", 64)
+    cfg.setdefault("report_cache_ttl_sec", 600)
+    cfg.setdefault("report_cache_grace_sec", 60)
+    cfg.setdefault("report_cache_bucket_sec", 300)
+    for key in ("api_rate_per_sec", "api_chat_rate_per_sec", "channel_posts_per_min"):
+        if not isinstance(cfg[key], (int, float)) or cfg[key] <= 0:
+            raise RuntimeError(f"config.json: '{key}' must be a positive number.")
     return cfg
 
 CONFIG = load_config()
\ No newline at end of file
@@ -0,0 +1,48 @@
+"""Per-user activity-day bitmaps.
+
+A user's active days are stored as one integer: bit i is set when the user
+wrote on day `first_day + i` (days as in the rollup tables). In SQLite the
+integer is kept as a little-endian BLOB.
+"""
+
+def to_blob(bits):
+    return bits.to_bytes(max(1, (bits.bit_length() + 7) // 8), "little")
+
+def from_blob(blob):
+    return int.from_bytes(blob, "little")
+
+def add_days(first_day, bits, days):
+    """Set the bits for `days`; returns the (possibly moved) first_day and the new bits."""
+    lowest = min(days)
+    if first_day is None:
+        first_day = lowest
+    elif lowest < first_day:
+        bits <<= first_day - lowest
+        first_day = lowest
+    for day in days:
+        bits |= 1 << (day - first_day)
+    return first_day, bits
+
+def window(first_day, bits, start_day, end_day):
+    """Bits for days start_day..end_day only, re-based so bit 0 is start_day."""
+    if start_day > first_day:
+        bits >>= start_day - first_day
+    else:
+        bits <<= first_day - start_day
+    return bits & ((1 << (end_day - start_day + 1)) - 1)
+
+def longest_run(bits):
+    """Length of the longest run of consecutive set bits."""
+    n = 0
+    while bits:
+        bits &= bits >> 1
+        n += 1
+    return n
+
+def current_run(first_day, bits, today):
+    """Consecutive active days ending today, or yesterday if today has no activity yet."""
+    if bits == 0 or first_day + bits.bit_length() - 1 < today - 1:
+        return 0
+    # Clearing the top run of ones leaves the highest zero bit as the new top.
+    length = bits.bit_length()
+    return length - (~bits & ((1 << length) - 1)).bit_length()
@@ -1,28 +1,112 @@
+import asyncio
+import time
 from contextlib import asynccontextmanager
 import aiosqlite
 
+import daybits
+from instrument import timed
+
 DB_PATH = "activity.sqlite3"
+DB_READERS = 3
+# Below every Telegram id and timestamp; the "start of list" keyset cursor.
+MIN_KEY = -(2 ** 63)
+
+PRAGMAS = (
+    # only takes effect on a new file (before WAL and the first table); see enable_incremental_vacuum()
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+# One writer connection guarded by a lock, plus a small pool of read-only
+# connections. WAL lets the readers run alongside the writer.
+_writer = None
+_write_lock = asyncio.Lock()
+_readers = None
+_reader_conns = []
+_open_lock = asyncio.Lock()
+
+async def _connect(path, read_only = False):
+    db = await aiosqlite.connect(path)
+    db.row_factory = aiosqlite.Row
+    for pragma in PRAGMAS:
+        await db.execute(pragma)
+    if read_only:
+        await db.execute("PRAGMA query_only=ON")
+    return db
+
+async def open_db(path = DB_PATH, readers = DB_READERS):
+    global _writer, _readers, _reader_conns
+    async with _open_lock:
+        if _writer is not None:
+            return
+        writer = await _connect(path)
+        reader_conns = [await _connect(path, read_only=True) for _ in range(max(1, readers))]
+        _readers = asyncio.Queue()
+        for db in reader_conns:
+            _readers.put_nowait(db)
+        _reader_conns = reader_conns
+        _writer = writer
+
+async def close_db():
+    global _writer, _readers, _reader_conns
+    async with _open_lock:
+        if _writer is None:
+            return
+        async with _write_lock:
+            await _writer.execute("PRAGMA optimize")
+            await _writer.commit()
+            await _writer.close()
+        for db in _reader_conns:
+            await db.close()
+        _writer = None
+        _readers = None
+        _reader_conns = []
 
 @asynccontextmanager
 async def db_conn():
-    db = await aiosqlite.connect(DB_PATH)
-    db.row_factory = aiosqlite.Row
+    if _writer is None:
+        await open_db()
+    async with _write_lock:
+        try:
+            yield _writer
+        except BaseException:
+            if _writer.in_transaction:
+                await _writer.rollback()
+            raise
+
+@asynccontextmanager
+async def db_read():
+    if _writer is None:
+        await open_db()
+    db = await _readers.get()
     try:
         yield db
     finally:
-        await db.close()
+        _readers.put_nowait(db)
 
 
-INIT_SQL = """
+# One row per (chat, user): profile copy plus the user's activity in that chat.
+ACTIVITY_SQL = """
 CREATE TABLE IF NOT EXISTS activity(
-  user_id INTEGER PRIMARY KEY,
+  chat_id INTEGER NOT NULL,
+  user_id INTEGER NOT NULL,
   username TEXT,
   first_name TEXT,
   last_name TEXT,
   is_bot INTEGER DEFAULT 0,
   joined_ts INTEGER,
-  last_msg_ts INTEGER
+  last_msg_ts INTEGER,
+  first_msg_ts INTEGER,
+  PRIMARY KEY(chat_id, user_id)
 );
+"""
+
+INIT_SQL = ACTIVITY_SQL + """
 CREATE TABLE IF NOT EXISTS scheduled_posts(
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   channel_id INTEGER NOT NULL,
@@ -32,6 +116,7 @@ CREATE TABLE IF NOT EXISTS scheduled_posts(
   status TEXT DEFAULT 'pending',
   sent_ts INTEGER
 );
+CREATE INDEX IF NOT EXISTS idx_scheduled_due ON scheduled_posts(status, run_at_ts);
 CREATE TABLE IF NOT EXISTS messages(
   chat_id INTEGER NOT NULL,
   message_id INTEGER NOT NULL,
@@ -39,187 +124,962 @@ CREATE TABLE IF NOT EXISTS messages(
   ts INTEGER NOT NULL,
   reply_to_message_id INTEGER,
   thread_id INTEGER,
+  first_reply_ts INTEGER,
+  reply_count INTEGER NOT NULL DEFAULT 0,
   PRIMARY KEY(chat_id, message_id)
 );
-CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages(ts);
-CREATE INDEX IF NOT EXISTS idx_messages_user_ts ON messages(user_id, ts);
-CREATE INDEX IF NOT EXISTS idx_messages_reply_to ON messages(reply_to_message_id);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_ts ON messages(chat_id, ts);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_user_ts ON messages(chat_id, user_id, ts);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_reply_to ON messages(chat_id, reply_to_message_id);
+CREATE TABLE IF NOT EXISTS members(
+  chat_id INTEGER NOT NULL,
+  user_id INTEGER NOT NULL,
+  status TEXT NOT NULL,
+  updated_ts INTEGER NOT NULL,
+  PRIMARY KEY(chat_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS daily_user_counts(
+  chat_id INTEGER NOT NULL,
+  day INTEGER NOT NULL,
+  user_id INTEGER NOT NULL,
+  msgs INTEGER NOT NULL DEFAULT 0,
+  replies INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY(chat_id, day, user_id)
+);
+CREATE TABLE IF NOT EXISTS hourly_counts(
+  chat_id INTEGER NOT NULL,
+  hour INTEGER NOT NULL,
+  msgs INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY(chat_id, hour)
+);
+CREATE TABLE IF NOT EXISTS activity_days(
+  chat_id INTEGER NOT NULL,
+  user_id INTEGER NOT NULL,
+  first_day INTEGER NOT NULL,
+  last_day INTEGER NOT NULL,
+  bits BLOB NOT NULL,
+  PRIMARY KEY(chat_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS active_users(
+  chat_id INTEGER NOT NULL,
+  user_id INTEGER NOT NULL,
+  last_ts INTEGER NOT NULL,
+  PRIMARY KEY(chat_id, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_active_users_ts ON active_users(chat_id, last_ts);
+CREATE TABLE IF NOT EXISTS meta(
+  key TEXT PRIMARY KEY,
+  value INTEGER
+);
+CREATE TABLE IF NOT EXISTS usernames(
+  username TEXT NOT NULL COLLATE NOCASE,
+  user_id INTEGER NOT NULL,
+  first_seen INTEGER NOT NULL,
+  last_seen INTEGER NOT NULL,
+  PRIMARY KEY(username, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS reply_sketches(
+  chat_id INTEGER NOT NULL,
+  day INTEGER NOT NULL,
+  sketch TEXT NOT NULL,
+  PRIMARY KEY(chat_id, day)
+) WITHOUT ROWID;
 """
 
-async def init_db():
+# Columns added after the first release: (table, column, declaration).
+MIGRATION_COLUMNS = (
+    ("activity", "first_msg_ts", "INTEGER"),
+    ("messages", "first_reply_ts", "INTEGER"),
+    ("messages", "reply_count", "INTEGER NOT NULL DEFAULT 0"),
+)
+
+# Indexes over migrated columns; created once the columns exist.
+# Every messages index leads with chat_id, so one chat's queries never
+# range over the others' rows; the unprefixed ones are dropped.
+POST_MIGRATION_SQL = """
+CREATE INDEX IF NOT EXISTS idx_messages_replied ON messages(chat_id, ts) WHERE first_reply_ts IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_activity_chat_username ON activity(chat_id, username COLLATE NOCASE);
+DROP INDEX IF EXISTS idx_messages_ts;
+DROP INDEX IF EXISTS idx_messages_user_ts;
+DROP INDEX IF EXISTS idx_messages_reply_to;
+"""
+
+async def _add_missing_columns(db):
+    added = set()
+    for table, column, decl in MIGRATION_COLUMNS:
+        cur = await db.execute(f"PRAGMA table_info({table})")
+        if column not in {r["name"] for r in await cur.fetchall()}:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+            added.add((table, column))
+    return added
+
+async def _backfill_reply_stats(db, chat_id):
+    await db.execute(
+        """
+        UPDATE messages SET (first_reply_ts, reply_count) = (
+          SELECT MIN(r.ts), COUNT(*) FROM messages r
+          WHERE r.chat_id = messages.chat_id AND r.reply_to_message_id = messages.message_id
+        )
+        WHERE chat_id = ? AND message_id IN (
+          SELECT reply_to_message_id FROM messages WHERE chat_id = ? AND reply_to_message_id IS NOT NULL
+        )
+        """,
+        (chat_id, chat_id),
+    )
+
+async def _backfill_activity_ts(db, chat_id = None):
+    where, params = ("WHERE chat_id = ?", (chat_id,)) if chat_id is not None else ("", ())
+    await db.execute(
+        f"""
+        UPDATE activity SET
+          first_msg_ts = COALESCE(
+            MIN(first_msg_ts, (SELECT MIN(ts) FROM messages m WHERE m.chat_id = activity.chat_id AND m.user_id = activity.user_id)),
+            (SELECT MIN(ts) FROM messages m WHERE m.chat_id = activity.chat_id AND m.user_id = activity.user_id),
+            first_msg_ts
+          ),
+          last_msg_ts = COALESCE(
+            MAX(last_msg_ts, (SELECT MAX(ts) FROM messages m WHERE m.chat_id = activity.chat_id AND m.user_id = activity.user_id)),
+            (SELECT MAX(ts) FROM messages m WHERE m.chat_id = activity.chat_id AND m.user_id = activity.user_id),
+            last_msg_ts
+          )
+        {where}
+        """,
+        params,
+    )
+
+async def _split_activity_by_chat(db, chat_id):
+    """Move a pre-multi-chat activity table (one row per user) to per-chat rows.
+
+    The old rows belong to the one chat the bot used to watch: chat_id, or
+    failing that the chat with the most stored messages.
+    """
+    cur = await db.execute("PRAGMA table_info(activity)")
+    if "chat_id" in {r["name"] for r in await cur.fetchall()}:
+        return False
+    if not chat_id:
+        cur = await db.execute("SELECT chat_id FROM messages GROUP BY chat_id ORDER BY COUNT(*) DESC LIMIT 1")
+        row = await cur.fetchone()
+        chat_id = row["chat_id"] if row else 0
+    if not db.in_transaction:
+        # DDL would autocommit; the rename and the copy must land together
+        await db.execute("BEGIN")
+    await db.execute("ALTER TABLE activity RENAME TO activity_v1")
+    await db.execute(ACTIVITY_SQL)
+    await db.execute(
+        """
+        INSERT INTO activity(chat_id, user_id, username, first_name, last_name, is_bot, joined_ts, last_msg_ts, first_msg_ts)
+        SELECT ?, user_id, username, first_name, last_name, is_bot, joined_ts, last_msg_ts, first_msg_ts FROM activity_v1
+        """,
+        (chat_id,),
+    )
+    await db.execute("DROP TABLE activity_v1")
+    return True
+
+async def _backfill_usernames(db):
+    """Seed the username history from the current activity profiles."""
+    await db.execute(
+        """
+        INSERT OR IGNORE INTO usernames(username, user_id, first_seen, last_seen)
+        SELECT username, user_id, COALESCE(first_msg_ts, joined_ts, last_msg_ts, 0), COALESCE(last_msg_ts, joined_ts, 0)
+        FROM activity WHERE username IS NOT NULL AND username != ''
+        """
+    )
+
+@timed("db")
+async def init_db(path = DB_PATH, readers = DB_READERS, legacy_chat_id = None):
+    """legacy_chat_id: the chat that rows from a single-chat database belong to."""
+    await open_db(path, readers)
     async with db_conn() as db:
         await db.executescript(INIT_SQL)
+        added = await _add_missing_columns(db)
+        if ("messages", "first_reply_ts") in added:
+            cur = await db.execute("SELECT DISTINCT chat_id FROM messages")
+            for row in await cur.fetchall():
+                await _backfill_reply_stats(db, row["chat_id"])
+        await _split_activity_by_chat(db, legacy_chat_id)
+        if ("activity", "first_msg_ts") in added:
+            await _backfill_activity_ts(db)
+        cur = await db.execute("SELECT EXISTS(SELECT 1 FROM usernames) AS filled")
+        if not (await cur.fetchone())["filled"]:
+            await _backfill_usernames(db)
+        await db.commit()
+        await db.executescript(POST_MIGRATION_SQL)
         await db.commit()
 
 
-async def upsert_user(u, *, joined_ts = None, last_msg_ts = None):
+@timed("db")
+async def upsert_user(chat_id, u, *, joined_ts = None, last_msg_ts = None):
     async with db_conn() as db:
-        row = await db.execute("SELECT user_id FROM activity WHERE user_id=?", (u.id,))
+        row = await db.execute("SELECT user_id FROM activity WHERE chat_id=? AND user_id=?", (chat_id, u.id))
         exists = await row.fetchone()
         if exists:
             if last_msg_ts is not None:
                 await db.execute(
-                    "UPDATE activity SET username=?, first_name=?, last_name=?, last_msg_ts=? WHERE user_id=?",
-                    (u.username, u.first_name, u.last_name, last_msg_ts, u.id),
+                    "UPDATE activity SET username=?, first_name=?, last_name=?, last_msg_ts=? WHERE chat_id=? AND user_id=?",
+                    (u.username, u.first_name, u.last_name, last_msg_ts, chat_id, u.id),
                 )
             if joined_ts is not None:
                 await db.execute(
-                    "UPDATE activity SET username=?, first_name=?, last_name=?, joined_ts=? WHERE user_id=?",
-                    (u.username, u.first_name, u.last_name, joined_ts, u.id),
+                    "UPDATE activity SET username=?, first_name=?, last_name=?, joined_ts=? WHERE chat_id=? AND user_id=?",
+                    (u.username, u.first_name, u.last_name, joined_ts, chat_id, u.id),
                 )
         else:
             await db.execute(
-                "INSERT INTO activity(user_id, username, first_name, last_name, is_bot, joined_ts, last_msg_ts) VALUES (?,?,?,?,?,?,?)",
-                (u.id, u.username, u.first_name, u.last_name, int(u.is_bot), joined_ts, last_msg_ts),
+                "INSERT INTO activity(chat_id, user_id, username, first_name, last_name, is_bot, joined_ts, last_msg_ts) VALUES (?,?,?,?,?,?,?,?)",
+                (chat_id, u.id, u.username, u.first_name, u.last_name, int(u.is_bot), joined_ts, last_msg_ts),
             )
+        if u.username:
+            seen = last_msg_ts or joined_ts or int(time.time())
+            await db.execute(UPSERT_USERNAME_SQL, (u.username, u.id, seen, seen))
         await db.commit()
 
-async def delete_user(user_id):
+@timed("db")
+async def delete_user(chat_id, user_id, day_of):
+    """Forget a user who left: profile, raw messages and their share of the rollups,
+    so the rollups stay what a rebuild from the remaining messages would give.
+
+    day_of maps a timestamp to the chat's local day; reply_sketches for days
+    whose reply latencies change are dropped and rebuild on the next read.
+    """
     async with db_conn() as db:
-        await db.execute("DELETE FROM activity WHERE user_id=?", (user_id,))
-        await db.execute("DELETE FROM messages WHERE user_id=?", (user_id,))
+        # messages the user replied to lose those replies from their reply stats
+        cur = await db.execute(
+            """
+            SELECT DISTINCT t.message_id, t.ts FROM messages r
+            JOIN messages t ON t.chat_id = r.chat_id AND t.message_id = r.reply_to_message_id
+            WHERE r.chat_id = ? AND r.user_id = ? AND t.user_id != ?
+            """,
+            (chat_id, user_id, user_id),
+        )
+        targets = await cur.fetchall()
+        cur = await db.execute(
+            "SELECT ts FROM messages WHERE chat_id=? AND user_id=? AND first_reply_ts IS NOT NULL",
+            (chat_id, user_id),
+        )
+        stale_days = {day_of(r["ts"]) for r in await cur.fetchall()} | {day_of(r["ts"]) for r in targets}
+        await db.execute(
+            """
+            UPDATE hourly_counts SET msgs = msgs - (
+                SELECT COUNT(*) FROM messages m WHERE m.chat_id = hourly_counts.chat_id AND m.user_id = ? AND m.ts / 3600 = hourly_counts.hour
+            )
+            WHERE chat_id = ? AND hour IN (SELECT DISTINCT ts / 3600 FROM messages WHERE chat_id = ? AND user_id = ?)
+            """,
+            (user_id, chat_id, chat_id, user_id),
+        )
+        await db.execute("DELETE FROM hourly_counts WHERE chat_id=? AND msgs <= 0", (chat_id,))
+        await db.execute("DELETE FROM daily_user_counts WHERE chat_id=? AND user_id=?", (chat_id, user_id))
+        await db.execute("DELETE FROM activity_days WHERE chat_id=? AND user_id=?", (chat_id, user_id))
+        await db.execute("DELETE FROM active_users WHERE chat_id=? AND user_id=?", (chat_id, user_id))
+        await db.execute("DELETE FROM activity WHERE chat_id=? AND user_id=?", (chat_id, user_id))
+        await db.execute("DELETE FROM messages WHERE chat_id=? AND user_id=?", (chat_id, user_id))
+        await db.executemany(
+            """
+            UPDATE messages SET (first_reply_ts, reply_count) = (
+              SELECT MIN(r.ts), COUNT(*) FROM messages r
+              WHERE r.chat_id = messages.chat_id AND r.reply_to_message_id = messages.message_id
+            )
+            WHERE chat_id = ? AND message_id = ?
+            """,
+            [(chat_id, r["message_id"]) for r in targets],
+        )
+        await db.executemany(
+            "DELETE FROM reply_sketches WHERE chat_id=? AND day=?",
+            [(chat_id, day) for day in stale_days],
+        )
         await db.commit()
 
-async def insert_message(chat, msg, user, now, reply_to, thread_id):
+UPSERT_ACTIVITY_SQL = """
+INSERT INTO activity(chat_id, user_id, username, first_name, last_name, is_bot, last_msg_ts, first_msg_ts) VALUES (?,?,?,?,?,?,?,?)
+ON CONFLICT(chat_id, user_id) DO UPDATE SET
+  username=excluded.username,
+  first_name=excluded.first_name,
+  last_name=excluded.last_name,
+  last_msg_ts=COALESCE(MAX(activity.last_msg_ts, excluded.last_msg_ts), activity.last_msg_ts, excluded.last_msg_ts),
+  first_msg_ts=COALESCE(MIN(activity.first_msg_ts, excluded.first_msg_ts), activity.first_msg_ts, excluded.first_msg_ts)
+"""
+
+UPSERT_USERNAME_SQL = """
+INSERT INTO usernames(username, user_id, first_seen, last_seen) VALUES (?,?,?,?)
+ON CONFLICT(username, user_id) DO UPDATE SET
+  username=excluded.username,
+  first_seen=MIN(usernames.first_seen, excluded.first_seen),
+  last_seen=MAX(usernames.last_seen, excluded.last_seen)
+"""
+
+UPSERT_ACTIVE_SQL = """
+INSERT INTO active_users(chat_id, user_id, last_ts) VALUES (?,?,?)
+ON CONFLICT(chat_id, user_id) DO UPDATE SET last_ts=MAX(active_users.last_ts, excluded.last_ts)
+"""
+
+@timed("db")
+async def set_member_statuses(rows):
+    """Record membership changes: (chat_id, user_id, status, updated_ts) tuples."""
+    if not rows:
+        return
     async with db_conn() as db:
+        await db.executemany(
+            """
+            INSERT INTO members(chat_id, user_id, status, updated_ts) VALUES (?,?,?,?)
+            ON CONFLICT(chat_id, user_id) DO UPDATE SET status=excluded.status, updated_ts=excluded.updated_ts
+            WHERE excluded.updated_ts >= members.updated_ts
+            """,
+            rows,
+        )
+        await db.executemany(
+            "DELETE FROM active_users WHERE chat_id=? AND user_id=?",
+            [(r[0], r[1]) for r in rows if r[2] in ("left", "kicked")],
+        )
+        await db.commit()
+
+UPSERT_DAILY_SQL = """
+INSERT INTO daily_user_counts(chat_id, day, user_id, msgs, replies) VALUES (?,?,?,?,?)
+ON CONFLICT(chat_id, day, user_id) DO UPDATE SET
+  msgs=daily_user_counts.msgs + excluded.msgs,
+  replies=daily_user_counts.replies + excluded.replies
+"""
+
+UPSERT_HOURLY_SQL = """
+INSERT INTO hourly_counts(chat_id, hour, msgs) VALUES (?,?,?)
+ON CONFLICT(chat_id, hour) DO UPDATE SET msgs=hourly_counts.msgs + excluded.msgs
+"""
+
+async def _new_messages(db, messages, days):
+    """Drop rows whose (chat_id, message_id) is already stored, so rollups never count twice."""
+    fresh = {}
+    for m, day in zip(messages, days):
+        fresh.setdefault((m[0], m[1]), (m, day))
+    by_chat = {}
+    for chat_id, message_id in fresh:
+        by_chat.setdefault(chat_id, []).append(message_id)
+    for chat_id, ids in by_chat.items():
+        qmarks = ",".join("?" for _ in ids)
+        cur = await db.execute(f"SELECT message_id FROM messages WHERE chat_id=? AND message_id IN ({qmarks})", (chat_id, *ids))
+        for row in await cur.fetchall():
+            fresh.pop((chat_id, row["message_id"]), None)
+    return list(fresh.values())
+
+async def _update_activity_days(db, per_user):
+    """Merge {(chat_id, user_id): set(days)} into the activity_days bitmaps."""
+    by_chat = {}
+    for chat_id, user_id in per_user:
+        by_chat.setdefault(chat_id, []).append(user_id)
+    current = {}
+    for chat_id, ids in by_chat.items():
+        qmarks = ",".join("?" for _ in ids)
+        cur = await db.execute(
+            f"SELECT user_id, first_day, bits FROM activity_days WHERE chat_id=? AND user_id IN ({qmarks})",
+            (chat_id, *ids),
+        )
+        for row in await cur.fetchall():
+            current[(chat_id, row["user_id"])] = (row["first_day"], daybits.from_blob(row["bits"]))
+    rows = []
+    for key, days in per_user.items():
+        first_day, bits = daybits.add_days(*current.get(key, (None, 0)), days)
+        rows.append((*key, first_day, first_day + bits.bit_length() - 1, daybits.to_blob(bits)))
+    await db.executemany(
+        "INSERT OR REPLACE INTO activity_days(chat_id, user_id, first_day, last_day, bits) VALUES (?,?,?,?,?)",
+        rows,
+    )
+
+@timed("db")
+async def ingest_batch(users, messages, days):
+    """Write a coalesced batch of user profiles and message rows in one transaction.
+
+    users: (chat_id, user_id, username, first_name, last_name, is_bot, last_msg_ts, first_msg_ts) tuples
+    messages: (chat_id, message_id, user_id, ts, reply_to_message_id, thread_id) tuples
+    days: local day of each message, for the rollup tables
+
+    Returns the (chat_id, user_id, last_ts) rows written to active_users.
+    """
+    active = {}
+    now = int(time.time())
+    async with db_conn() as db:
+        if users:
+            await db.executemany(UPSERT_ACTIVITY_SQL, users)
+            await db.executemany(UPSERT_USERNAME_SQL, [(u[2], u[1], u[6] or now, u[6] or now) for u in users if u[2]])
+        if messages:
+            fresh = await _new_messages(db, messages, days)
+            await db.executemany(
+                "INSERT INTO messages(chat_id, message_id, user_id, ts, reply_to_message_id, thread_id) VALUES (?,?,?,?,?,?)",
+                [m for m, _ in fresh],
+            )
+            await db.executemany(
+                """
+                UPDATE messages SET reply_count = reply_count + 1, first_reply_ts = MIN(COALESCE(first_reply_ts, ?), ?)
+                WHERE chat_id=? AND message_id=?
+                """,
+                [(m[3], m[3], m[0], m[4]) for m, _ in fresh if m[4] is not None],
+            )
+            daily = {}
+            hourly = {}
+            active_days = {}
+            bots = {u[1] for u in users if u[5]}
+            for m, day in fresh:
+                if m[2] not in bots:
+                    key = (m[0], m[2])
+                    active[key] = max(active.get(key, m[3]), m[3])
+                active_days.setdefault((m[0], m[2]), set()).add(day)
+                counts = daily.setdefault((m[0], day, m[2]), [0, 0])
+                counts[0] += 1
+                counts[1] += m[4] is not None
+                hour_key = (m[0], m[3] // 3600)
+                hourly[hour_key] = hourly.get(hour_key, 0) + 1
+            await db.executemany(UPSERT_DAILY_SQL, [(*k, v[0], v[1]) for k, v in daily.items()])
+            await db.executemany(UPSERT_HOURLY_SQL, [(*k, n) for k, n in hourly.items()])
+            await _update_activity_days(db, active_days)
+            await db.executemany(UPSERT_ACTIVE_SQL, [(*k, ts) for k, ts in active.items()])
+        await db.commit()
+    return [(*k, ts) for k, ts in active.items()]
+
+@timed("db")
+async def rebuild_daily_counts(chat_id, day_of, since_ts = None):
+    """Recompute daily_user_counts for a chat from the raw messages.
+
+    Messages are grouped in SQL by 15-minute slots (every UTC offset is a
+    multiple of 15 minutes), and `day_of(ts)` maps each slot to its local day.
+    With since_ts (a local day start, the retention horizon) only the days
+    from there on are rebuilt; older days exist only as rollups.
+    Returns the number of rollup rows written.
+    """
+    since_ts = MIN_KEY if since_ts is None else since_ts
+    async with db_conn() as db:
+        cur = await db.execute(
+            """
+            SELECT user_id, ts / 900 AS slot, COUNT(*) AS msgs, COUNT(reply_to_message_id) AS replies
+            FROM messages WHERE chat_id=? AND ts >= ? GROUP BY user_id, slot
+            """,
+            (chat_id, since_ts),
+        )
+        daily = {}
+        day_cache = {}
+        for row in await cur.fetchall():
+            slot = row["slot"]
+            day = day_cache.get(slot)
+            if day is None:
+                day = day_cache[slot] = day_of(slot * 900)
+            counts = daily.setdefault((chat_id, day, row["user_id"]), [0, 0])
+            counts[0] += row["msgs"]
+            counts[1] += row["replies"]
         await db.execute(
-            "INSERT OR IGNORE INTO messages(chat_id, message_id, user_id, ts, reply_to_message_id, thread_id) VALUES (?,?,?,?,?,?)",
-            (chat.id, msg.message_id, user.id, now, reply_to, thread_id),
+            "DELETE FROM daily_user_counts WHERE chat_id=? AND day >= ?",
+            (chat_id, MIN_KEY if since_ts == MIN_KEY else day_of(since_ts)),
+        )
+        await db.executemany(
+            "INSERT INTO daily_user_counts(chat_id, day, user_id, msgs, replies) VALUES (?,?,?,?,?)",
+            [(*k, v[0], v[1]) for k, v in daily.items()],
+        )
+        await db.commit()
+        return len(daily)
+
+@timed("db")
+async def rebuild_reply_stats(chat_id):
+    """Recompute first_reply_ts/reply_count on every replied-to message of a chat,
+    and first/last message timestamps on activity."""
+    async with db_conn() as db:
+        await _backfill_reply_stats(db, chat_id)
+        await _backfill_activity_ts(db, chat_id)
+        await db.commit()
+
+@timed("db")
+async def rebuild_hourly_counts(chat_id, since_ts = None):
+    """Recompute hourly_counts (UTC hour buckets) for a chat from the raw messages,
+    leaving hours that started before since_ts alone."""
+    # first whole hour at or after since_ts; a partly compacted hour keeps its rollup row
+    since_hour = MIN_KEY if since_ts is None else -(-since_ts // 3600)
+    async with db_conn() as db:
+        await db.execute("DELETE FROM hourly_counts WHERE chat_id=? AND hour >= ?", (chat_id, since_hour))
+        cur = await db.execute(
+            """
+            INSERT INTO hourly_counts(chat_id, hour, msgs)
+            SELECT chat_id, ts / 3600, COUNT(*) FROM messages WHERE chat_id=? AND ts / 3600 >= ? GROUP BY ts / 3600
+            """,
+            (chat_id, since_hour),
         )
         await db.commit()
+        return cur.rowcount
+
+@timed("db")
+async def rebuild_activity_days(chat_id):
+    """Recompute the activity_days bitmaps for a chat from daily_user_counts."""
+    async with db_conn() as db:
+        cur = await db.execute("SELECT user_id, day FROM daily_user_counts WHERE chat_id=?", (chat_id,))
+        per_user = {}
+        for row in await cur.fetchall():
+            per_user.setdefault((chat_id, row["user_id"]), set()).add(row["day"])
+        await db.execute("DELETE FROM activity_days WHERE chat_id=?", (chat_id,))
+        await _update_activity_days(db, per_user)
+        await db.commit()
+        return len(per_user)
+
+@timed("db")
+async def rollups_need_backfill(chat_id):
+    async with db_read() as db:
+        cur = await db.execute(
+            """
+            SELECT EXISTS(SELECT 1 FROM messages WHERE chat_id=?)
+               AND (NOT EXISTS(SELECT 1 FROM daily_user_counts WHERE chat_id=?)
+                    OR NOT EXISTS(SELECT 1 FROM hourly_counts WHERE chat_id=?)
+                    OR NOT EXISTS(SELECT 1 FROM activity_days WHERE chat_id=?)) AS needed
+            """,
+            (chat_id, chat_id, chat_id, chat_id),
+        )
+        row = await cur.fetchone()
+    return bool(row["needed"])
+
+@timed("db")
+async def fetch_meta(key, default = None):
+    async with db_read() as db:
+        cur = await db.execute("SELECT value FROM meta WHERE key=?", (key,))
+        row = await cur.fetchone()
+    return default if row is None else row["value"]
+
+@timed("db")
+async def set_meta(key, value):
+    async with db_conn() as db:
+        await db.execute("INSERT INTO meta(key, value) VALUES (?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, value))
+        await db.commit()
+
+@timed("db")
+async def delete_messages_before(chat_id, before_ts, limit):
+    """Delete at most `limit` raw messages older than before_ts; one short write transaction."""
+    async with db_conn() as db:
+        cur = await db.execute(
+            """
+            DELETE FROM messages WHERE rowid IN (
+              SELECT rowid FROM messages WHERE ts < ? AND chat_id = ? LIMIT ?
+            )
+            """,
+            (before_ts, chat_id, limit),
+        )
+        await db.commit()
+        return cur.rowcount
+
+@timed("db")
+async def enable_incremental_vacuum():
+    """Switch a database created without auto_vacuum to INCREMENTAL. Runs a full VACUUM
+    under the write lock (ingest waits for it) and needs free disk about twice the file size."""
+    async with db_conn() as db:
+        cur = await db.execute("PRAGMA auto_vacuum")
+        if (await cur.fetchone())[0] == 2:
+            return False
+        await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await db.execute("VACUUM")
+        return True
+
+@timed("db")
+async def incremental_vacuum(pages):
+    """Release up to `pages` free pages back to the OS; returns how many are still free,
+    or None when the database is not in INCREMENTAL auto_vacuum mode."""
+    async with db_conn() as db:
+        cur = await db.execute("PRAGMA auto_vacuum")
+        if (await cur.fetchone())[0] != 2:
+            return None
+        # the pragma frees one page per step, so it has to be read to the end
+        cur = await db.execute(f"PRAGMA incremental_vacuum({int(pages)})")
+        await cur.fetchall()
+        await db.commit()
+        cur = await db.execute("PRAGMA freelist_count")
+        free = (await cur.fetchone())[0]
+        await db.execute("PRAGMA shrink_memory")
+        return free
 
-async def fetch_messages_since(since_ts, chat_id):
+@timed("db")
+async def rebuild_active_users(chat_id, since_ts):
+    """Refill a chat's active_users rows from the raw messages newer than since_ts."""
     async with db_conn() as db:
+        await db.execute("DELETE FROM active_users WHERE chat_id=?", (chat_id,))
         cur = await db.execute(
-            "SELECT chat_id, message_id, user_id, ts, reply_to_message_id, thread_id FROM messages WHERE chat_id=? AND ts>=? ORDER BY ts ASC",
+            """
+            INSERT INTO active_users(chat_id, user_id, last_ts)
+            SELECT m.chat_id, m.user_id, MAX(m.ts) FROM messages m
+            LEFT JOIN activity a ON a.chat_id = m.chat_id AND a.user_id = m.user_id
+            LEFT JOIN members mb ON mb.chat_id = m.chat_id AND mb.user_id = m.user_id
+            WHERE m.chat_id = ? AND m.ts >= ? AND COALESCE(a.is_bot, 0) = 0 AND COALESCE(mb.status, '') NOT IN ('left', 'kicked')
+            GROUP BY m.user_id
+            """,
             (chat_id, since_ts),
         )
+        await db.commit()
+        return cur.rowcount
+
+@timed("db")
+async def expire_active_users(before_ts):
+    async with db_conn() as db:
+        cur = await db.execute("DELETE FROM active_users WHERE last_ts < ?", (before_ts,))
+        await db.commit()
+        return cur.rowcount
+
+@timed("db")
+async def fetch_active_user_ts(since_ts):
+    async with db_read() as db:
+        cur = await db.execute("SELECT chat_id, user_id, last_ts FROM active_users WHERE last_ts >= ?", (since_ts,))
+        return [tuple(r) for r in await cur.fetchall()]
+
+@timed("db")
+async def fetch_window_totals(chat_id, start_day, end_day):
+    async with db_read() as db:
+        cur = await db.execute(
+            """
+            SELECT COALESCE(SUM(msgs), 0) AS msgs, COALESCE(SUM(replies), 0) AS replies, COUNT(DISTINCT user_id) AS users
+            FROM daily_user_counts WHERE chat_id=? AND day BETWEEN ? AND ?
+            """,
+            (chat_id, start_day, end_day),
+        )
+        return await cur.fetchone()
+
+@timed("db")
+async def fetch_user_count_values(chat_id, start_day, end_day):
+    """Per-user message totals for the window, ascending (for percentiles)."""
+    async with db_read() as db:
+        cur = await db.execute(
+            """
+            SELECT SUM(msgs) AS n FROM daily_user_counts WHERE chat_id=? AND day BETWEEN ? AND ?
+            GROUP BY user_id ORDER BY n ASC
+            """,
+            (chat_id, start_day, end_day),
+        )
+        return [r["n"] for r in await cur.fetchall()]
+
+@timed("db")
+async def fetch_top_users(chat_id, start_day, end_day, limit, column = "msgs"):
+    if column not in ("msgs", "replies"):
+        raise ValueError(f"unknown rollup column: {column}")
+    async with db_read() as db:
+        cur = await db.execute(
+            f"""
+            SELECT user_id, SUM({column}) AS n FROM daily_user_counts WHERE chat_id=? AND day BETWEEN ? AND ?
+            GROUP BY user_id HAVING n > 0 ORDER BY n DESC, user_id ASC LIMIT ?
+            """,
+            (chat_id, start_day, end_day, limit),
+        )
+        return [(r["user_id"], r["n"]) for r in await cur.fetchall()]
+
+@timed("db")
+async def count_new_users(chat_id, since_ts, until_ts):
+    """Users whose first message in the chat was sent in [since_ts, until_ts)."""
+    async with db_read() as db:
+        cur = await db.execute(
+            "SELECT COUNT(*) AS n FROM activity WHERE chat_id=? AND first_msg_ts >= ? AND first_msg_ts < ? AND is_bot = 0",
+            (chat_id, since_ts, until_ts),
+        )
+        row = await cur.fetchone()
+    return row["n"]
+
+@timed("db")
+async def fetch_reply_deltas(chat_id, start_ts, end_ts):
+    """(ts, seconds to first reply) for replied messages sent in [start_ts, end_ts)."""
+    async with db_read() as db:
+        cur = await db.execute(
+            """
+            SELECT ts, first_reply_ts - ts AS delta FROM messages INDEXED BY idx_messages_replied
+            WHERE chat_id=? AND ts>=? AND ts<? AND first_reply_ts IS NOT NULL AND first_reply_ts >= ts
+            """,
+            (chat_id, start_ts, end_ts),
+        )
+        return [(r["ts"], r["delta"]) for r in await cur.fetchall()]
+
+@timed("db")
+async def fetch_reply_sketches(chat_id, start_day, end_day):
+    async with db_read() as db:
+        cur = await db.execute(
+            "SELECT day, sketch FROM reply_sketches WHERE chat_id=? AND day BETWEEN ? AND ?",
+            (chat_id, start_day, end_day),
+        )
+        return {r["day"]: r["sketch"] for r in await cur.fetchall()}
+
+@timed("db")
+async def save_reply_sketches(chat_id, rows):
+    """rows: (day, sketch JSON)."""
+    if not rows:
+        return
+    async with db_conn() as db:
+        await db.executemany(
+            "INSERT OR REPLACE INTO reply_sketches(chat_id, day, sketch) VALUES (?,?,?)",
+            [(chat_id, day, sketch) for day, sketch in rows],
+        )
+        await db.commit()
+
+@timed("db")
+async def delete_reply_sketches(chat_id):
+    async with db_conn() as db:
+        await db.execute("DELETE FROM reply_sketches WHERE chat_id=?", (chat_id,))
+        await db.commit()
+
+@timed("db")
+async def fetch_daily_user_counts(chat_id, start_day, end_day):
+    """Raw (day, user_id, msgs, replies) rollup tuples for a window, for columnar processing."""
+    async with db_read() as db:
+        cur = await db.execute(
+            "SELECT day, user_id, msgs, replies FROM daily_user_counts WHERE chat_id=? AND day BETWEEN ? AND ?",
+            (chat_id, start_day, end_day),
+        )
+        return [tuple(r) for r in await cur.fetchall()]
+
+@timed("db")
+async def fetch_day_counts(chat_id, start_day, end_day):
+    async with db_read() as db:
+        cur = await db.execute(
+            """
+            SELECT day, SUM(msgs) AS msgs, SUM(replies) AS replies
+            FROM daily_user_counts WHERE chat_id=? AND day BETWEEN ? AND ?
+            GROUP BY day ORDER BY day ASC
+            """,
+            (chat_id, start_day, end_day),
+        )
         return await cur.fetchall()
-    
+
+@timed("db")
+async def fetch_hour_counts(chat_id, start_hour):
+    async with db_read() as db:
+        cur = await db.execute(
+            "SELECT hour, msgs FROM hourly_counts WHERE chat_id=? AND hour>=?",
+            (chat_id, start_hour),
+        )
+        return await cur.fetchall()
+
+@timed("db")
+async def fetch_activity_days(chat_id, since_day):
+    """Active-day bitmaps of users seen on or after since_day: {user_id: (first_day, last_day, bits)}."""
+    async with db_read() as db:
+        cur = await db.execute(
+            "SELECT user_id, first_day, last_day, bits FROM activity_days WHERE chat_id=? AND last_day>=?",
+            (chat_id, since_day),
+        )
+        rows = await cur.fetchall()
+    return {r["user_id"]: (r["first_day"], r["last_day"], daybits.from_blob(r["bits"])) for r in rows}
+
+@timed("db")
 async def fetch_first_msg_ts_per_user(chat_id):
-    async with db_conn() as db:
+    async with db_read() as db:
         cur = await db.execute(
-            "SELECT user_id, MIN(ts) AS first_ts FROM messages WHERE chat_id=? GROUP BY user_id",
+            "SELECT user_id, first_msg_ts FROM activity WHERE chat_id=? AND first_msg_ts IS NOT NULL AND is_bot = 0",
             (chat_id,),
         )
         rows = await cur.fetchall()
-    return {r["user_id"]: r["first_ts"] for r in rows}
+    return {r["user_id"]: r["first_msg_ts"] for r in rows}
 
+@timed("db")
 async def fetch_last_msg_ts_per_user(chat_id):
-    async with db_conn() as db:
+    async with db_read() as db:
         cur = await db.execute(
-            "SELECT user_id, MAX(ts) AS last_ts FROM messages WHERE chat_id=? GROUP BY user_id",
+            "SELECT user_id, last_msg_ts FROM activity WHERE chat_id=? AND last_msg_ts IS NOT NULL AND is_bot = 0",
             (chat_id,),
         )
         rows = await cur.fetchall()
-    return {r["user_id"]: r["last_ts"] for r in rows}
+    return {r["user_id"]: r["last_msg_ts"] for r in rows}
+
+@timed("db")
+async def find_users_by_username(chat_id, username, limit = 3):
+    """Candidate users for @username (any case): current holders in the chat first, then past ones, newest first."""
+    async with db_read() as db:
+        cur = await db.execute(
+            """
+            SELECT user_id, username, first_name, last_name FROM (
+                SELECT a.user_id, a.username, a.first_name, a.last_name, 0 AS past, COALESCE(a.last_msg_ts, a.joined_ts, 0) AS seen
+                FROM activity a WHERE a.chat_id = ? AND a.username = ? COLLATE NOCASE
+                UNION ALL
+                SELECT u.user_id, a.username, a.first_name, a.last_name, 1 AS past, u.last_seen AS seen
+                FROM usernames u LEFT JOIN activity a ON a.chat_id = ? AND a.user_id = u.user_id
+                WHERE u.username = ?
+            )
+            GROUP BY user_id ORDER BY MIN(past), MAX(seen) DESC LIMIT ?
+            """,
+            (chat_id, username, chat_id, username, limit),
+        )
+        return await cur.fetchall()
 
-async def user_display_names(u_ids):
+@timed("db")
+async def user_display_names(chat_id, u_ids):
     if not u_ids:
         return {}
     qmarks = ",".join("?" for _ in u_ids)
-    async with db_conn() as db:
-        cur = await db.execute(f"SELECT user_id, COALESCE(username, first_name, CAST(user_id AS TEXT)) AS name FROM activity WHERE user_id IN ({qmarks})", tuple(u_ids))
+    async with db_read() as db:
+        cur = await db.execute(f"SELECT user_id, COALESCE(username, first_name, CAST(user_id AS TEXT)) AS name FROM activity WHERE chat_id=? AND user_id IN ({qmarks})", (chat_id, *u_ids))
         rows = await cur.fetchall()
     return {r["user_id"]: (f"@{r['name']}" if isinstance(r["name"], str) and r["name"] else str(r["user_id"])) for r in rows}
 
-async def add_scheduled_post(file_id, run_at_utc, channel_id):
+@timed("db")
+async def add_scheduled_posts(rows):
+    """Insert (file_id, run_at_utc, channel_id) rows in one transaction."""
+    if not rows:
+        return
     async with db_conn() as db:
-        cur = await db.execute(
+        await db.executemany(
             "INSERT INTO scheduled_posts(channel_id, run_at_ts, file_id) VALUES (?,?,?)",
-            (channel_id, int(run_at_utc.timestamp()), file_id),
+            [(channel_id, int(run_at_utc.timestamp()), file_id) for file_id, run_at_utc, channel_id in rows],
         )
         await db.commit()
-        return cur.lastrowid
 
-async def fetch_all_users(page_size, offset):
-    async with db_conn() as db:
+# Member listings use keyset pagination: `after` is the sort key of the last
+# row of the previous page (None for the first page), so deep pages cost the
+# same as page 1. `offset` is only for jumping to a page without a token.
+
+@timed("db")
+async def fetch_all_users(chat_id, page_size, after = None, offset = 0):
+    async with db_read() as db:
         cur = await db.execute(
             """
-            SELECT user_id, username, first_name, last_name
-            FROM activity
-            WHERE is_bot = 0
-            ORDER BY user_id ASC
+            SELECT a.user_id, a.username, a.first_name, a.last_name, mb.status AS member_status
+            FROM activity a
+            LEFT JOIN members mb ON mb.chat_id = a.chat_id AND mb.user_id = a.user_id
+            WHERE a.chat_id = ? AND a.is_bot = 0 AND COALESCE(mb.status, '') NOT IN ('left', 'kicked') AND a.user_id > ?
+            ORDER BY a.user_id ASC
             LIMIT ? OFFSET ?
             """,
-            (page_size, offset),
+            (chat_id, after[0] if after else MIN_KEY, page_size, offset),
         )
-        rows = await cur.fetchall()
-        # Count total users for pagination info
+        return await cur.fetchall()
+
+@timed("db")
+async def count_all_users(chat_id):
+    async with db_read() as db:
         cur = await db.execute(
             """
-            SELECT COUNT(user_id) as total
-            FROM activity
-            WHERE is_bot = 0
+            SELECT COUNT(a.user_id) as total
+            FROM activity a
+            LEFT JOIN members mb ON mb.chat_id = a.chat_id AND mb.user_id = a.user_id
+            WHERE a.chat_id = ? AND a.is_bot = 0 AND COALESCE(mb.status, '') NOT IN ('left', 'kicked')
             """,
+            (chat_id,),
         )
-        
         total_row = await cur.fetchone()
-        total_users = total_row["total"] if total_row else 0
-        
-        return (rows, total_users)
+        return total_row["total"] if total_row else 0
 
-async def fetch_active_users(chat_id, threshold, page_size, offset):
-    async with db_conn() as db:
-        # Fetch active users (with messages in the last 7 days)
+@timed("db")
+async def fetch_active_users(chat_id, threshold, page_size, after = None, offset = 0):
+    async with db_read() as db:
+        # Active users come from the materialized active_users set, not from messages
         cur = await db.execute("""
-            SELECT DISTINCT a.user_id, a.username, a.first_name, a.last_name
-            FROM activity a
-            JOIN messages m ON a.user_id = m.user_id
-            WHERE m.chat_id = ? AND m.ts >= ? AND a.is_bot = 0
-            ORDER BY a.user_id ASC
+            SELECT a.user_id, a.username, a.first_name, a.last_name, mb.status AS member_status
+            FROM active_users au
+            JOIN activity a ON a.chat_id = au.chat_id AND a.user_id = au.user_id
+            LEFT JOIN members mb ON mb.chat_id = au.chat_id AND mb.user_id = au.user_id
+            WHERE au.chat_id = ? AND au.user_id > ? AND au.last_ts >= ?
+            ORDER BY au.user_id ASC
             LIMIT ? OFFSET ?
             """,
-            (chat_id, threshold, page_size, offset),
+            (chat_id, after[0] if after else MIN_KEY, threshold, page_size, offset),
         )
-        rows = await cur.fetchall()
-        # Count total active users for pagination info
-        cur = await db.execute(
-                """
-                SELECT COUNT(DISTINCT a.user_id) as total
-                FROM activity a
-                JOIN messages m ON a.user_id = m.user_id
-                WHERE m.chat_id = ? AND m.ts >= ? AND a.is_bot = 0
-                """,
-                (chat_id, threshold),
-        )
-        total_row = await cur.fetchone()
-        total_active = total_row["total"] if total_row else 0
-        
-        return (rows, total_active)
+        return await cur.fetchall()
 
-async def fetch_inactive_users(chat_id, threshold, page_size, offset):
-    async with db_conn() as db:
-        # Fetch users who have no messages in the last 7 days or no messages at all
+@timed("db")
+async def fetch_silent_users(chat_id, threshold, page_size, after = None, offset = 0):
+    async with db_read() as db:
+        # Fetch users outside the active set (no messages since threshold or none at all)
         cur = await db.execute(
             """
-            SELECT a.user_id, a.username, a.first_name, a.last_name
+            SELECT a.user_id, a.username, a.first_name, a.last_name, mb.status AS member_status
             FROM activity a
-            LEFT JOIN messages m ON a.user_id = m.user_id AND m.chat_id = ? AND m.ts >= ?
-            WHERE a.is_bot = 0 AND (m.user_id IS NULL OR m.ts IS NULL)
+            LEFT JOIN members mb ON mb.chat_id = a.chat_id AND mb.user_id = a.user_id
+            WHERE a.chat_id = ? AND a.is_bot = 0 AND COALESCE(mb.status, '') NOT IN ('left', 'kicked') AND a.user_id > ?
+              AND NOT EXISTS(SELECT 1 FROM active_users au WHERE au.chat_id = a.chat_id AND au.user_id = a.user_id AND au.last_ts >= ?)
             ORDER BY a.user_id ASC
             LIMIT ? OFFSET ?
             """,
-            (chat_id, threshold, page_size, offset),
+            (chat_id, after[0] if after else MIN_KEY, threshold, page_size, offset),
         )
-        rows = await cur.fetchall()
-        # Count total silent users for pagination info
+        return await cur.fetchall()
+
+INACTIVE_WHERE = """
+    a.chat_id = ? AND a.is_bot=0 AND COALESCE(mb.status, '') NOT IN ('left', 'kicked')
+    AND (
+        (a.last_msg_ts IS NOT NULL AND a.last_msg_ts < ?)
+        OR (a.last_msg_ts IS NULL AND COALESCE(a.joined_ts, ?) < ?)
+    )
+"""
+
+@timed("db")
+async def fetch_inactive_users(chat_id, threshold, reference_date, page_size, after = None, offset = 0):
+    """Users silent since threshold, oldest activity first; keyset on (COALESCE(last_msg_ts, joined_ts, reference_date), user_id)."""
+    after_ts, after_id = after if after else (MIN_KEY, MIN_KEY)
+    async with db_read() as db:
         cur = await db.execute(
-            """
-            SELECT COUNT(DISTINCT a.user_id) as total
+            f"""
+            SELECT * FROM (
+                SELECT a.user_id, a.username, a.first_name, a.last_name, a.last_msg_ts, a.joined_ts, mb.status AS member_status,
+                       COALESCE(a.last_msg_ts, a.joined_ts, ?) AS sort_ts
+                FROM activity a
+                LEFT JOIN members mb ON mb.chat_id = a.chat_id AND mb.user_id = a.user_id
+                WHERE {INACTIVE_WHERE}
+            )
+            WHERE sort_ts > ? OR (sort_ts = ? AND user_id > ?)
+            ORDER BY sort_ts ASC, user_id ASC
+            LIMIT ? OFFSET ?
+            """,
+            (reference_date, chat_id, threshold, reference_date, threshold, after_ts, after_ts, after_id, page_size, offset),
+        )
+        return await cur.fetchall()
+
+@timed("db")
+async def count_inactive_users(chat_id, threshold, reference_date):
+    async with db_read() as db:
+        cur = await db.execute(
+            f"""
+            SELECT COUNT(a.user_id) AS total
             FROM activity a
-            LEFT JOIN messages m ON a.user_id = m.user_id AND m.chat_id = ? AND m.ts >= ?
-            WHERE a.is_bot = 0 AND (m.user_id IS NULL OR m.ts IS NULL)
+            LEFT JOIN members mb ON mb.chat_id = a.chat_id AND mb.user_id = a.user_id
+            WHERE {INACTIVE_WHERE}
             """,
-            (chat_id, threshold),
+            (chat_id, threshold, reference_date, threshold),
         )
         total_row = await cur.fetchone()
-        total_silent = total_row["total"] if total_row else 0
-        
-        return rows, total_silent
+        return total_row["total"] if total_row else 0
+
+# Export streams: each chunk is its own short read on a pooled reader, so a
+# long export neither pins a connection nor holds back WAL checkpoints.
+
+@timed("db")
+async def message_chat_ids():
+    async with db_read() as db:
+        cur = await db.execute("SELECT DISTINCT chat_id FROM messages ORDER BY chat_id")
+        return [r["chat_id"] for r in await cur.fetchall()]
+
+async def iter_messages(after = None, chunk = 5000):
+    """Yield message rows chat by chat in message_id order, `chunk` rows at a time.
+
+    after maps chat_id to the last message_id already seen. Telegram message
+    ids only grow within a chat, so the keyset survives VACUUM and deletes,
+    which may renumber or reuse rowids.
+    """
+    after = after or {}
+    for chat_id in await message_chat_ids():
+        after_id = after.get(chat_id, MIN_KEY)
+        while True:
+            async with db_read() as db:
+                cur = await db.execute(
+                    """
+                    SELECT chat_id, message_id, user_id, ts, reply_to_message_id, thread_id, first_reply_ts, reply_count
+                    FROM messages WHERE chat_id = ? AND message_id > ? ORDER BY message_id LIMIT ?
+                    """,
+                    (chat_id, after_id, chunk),
+                )
+                rows = await cur.fetchmany(chunk)
+            if not rows:
+                break
+            after_id = rows[-1]["message_id"]
+            yield rows
 
+async def iter_activity(after = (MIN_KEY, MIN_KEY), chunk = 5000):
+    """Yield activity rows by (chat_id, user_id), `chunk` rows at a time."""
+    after_chat, after_user = after
+    while True:
+        async with db_read() as db:
+            cur = await db.execute(
+                """
+                SELECT chat_id, user_id, username, first_name, last_name, is_bot, joined_ts, first_msg_ts, last_msg_ts
+                FROM activity WHERE (chat_id, user_id) > (?, ?) ORDER BY chat_id, user_id LIMIT ?
+                """,
+                (after_chat, after_user, chunk),
+            )
+            rows = await cur.fetchmany(chunk)
+        if not rows:
+            return
+        after_chat, after_user = rows[-1]["chat_id"], rows[-1]["user_id"]
+        yield rows
+
+@timed("db")
 async def fetch_scheduled_posts(channel_id):
-    async with db_conn() as db:
+    async with db_read() as db:
         cur = await db.execute(
             "SELECT id, run_at_ts FROM scheduled_posts WHERE status='pending' AND channel_id=? ORDER BY run_at_ts ASC",
             (channel_id,),
@@ -227,43 +1087,72 @@ async def fetch_scheduled_posts(channel_id):
 
         return await cur.fetchall() 
 
-async def fetch_all_scheduled_posts():
-    async with db_conn() as db:
+@timed("db")
+async def next_scheduled_ts(since_ts):
+    """run_at_ts of the earliest pending post at or after since_ts, or None."""
+    async with db_read() as db:
         cur = await db.execute(
-            "SELECT id, run_at_ts FROM scheduled_posts WHERE status='pending'",
+            "SELECT MIN(run_at_ts) AS ts FROM scheduled_posts WHERE status='pending' AND run_at_ts >= ?",
+            (since_ts,),
         )
-        return await cur.fetchall()
+        return (await cur.fetchone())["ts"]
 
-async def fetch_inactive_users(threshold, reference_date):
+@timed("db")
+async def claim_due_posts(since_ts, now_ts, limit):
+    """Mark up to `limit` pending posts due in [since_ts, now_ts] as 'sending' and return them."""
     async with db_conn() as db:
-        # Fetch all potential inactive users
         cur = await db.execute(
             """
-            SELECT user_id, username, first_name, last_name, last_msg_ts, joined_ts 
-            FROM activity 
-            WHERE is_bot=0 
-            AND (
-                (last_msg_ts IS NOT NULL AND last_msg_ts < ?) 
-                OR (last_msg_ts IS NULL AND COALESCE(joined_ts, ?) < ?)
-            ) 
-            ORDER BY COALESCE(last_msg_ts, joined_ts, ?) ASC
+            SELECT * FROM scheduled_posts WHERE status='pending' AND run_at_ts BETWEEN ? AND ?
+            ORDER BY run_at_ts ASC LIMIT ?
             """,
-            (threshold, reference_date, threshold, reference_date),
+            (since_ts, now_ts, limit),
+        )
+        rows = await cur.fetchall()
+        if rows:
+            await db.executemany("UPDATE scheduled_posts SET status='sending' WHERE id=?", [(r["id"],) for r in rows])
+            await db.commit()
+        return rows
+
+@timed("db")
+async def finish_scheduled_posts(results):
+    """(status, updated_ts, post_id) tuples for claimed posts, in one transaction."""
+    if not results:
+        return
+    async with db_conn() as db:
+        await db.executemany("UPDATE scheduled_posts SET status=?, sent_ts=? WHERE id=?", results)
+        await db.commit()
+
+@timed("db")
+async def expire_scheduled_posts(before_ts, now_ts):
+    async with db_conn() as db:
+        cur = await db.execute(
+            "UPDATE scheduled_posts SET status='expired', sent_ts=? WHERE status='pending' AND run_at_ts < ?",
+            (now_ts, before_ts),
+        )
+        await db.commit()
+        return cur.rowcount
+
+@timed("db")
+async def fetch_overdue_posts(now_ts):
+    async with db_read() as db:
+        cur = await db.execute(
+            "SELECT id, run_at_ts FROM scheduled_posts WHERE status='pending' AND run_at_ts < ? ORDER BY run_at_ts ASC",
+            (now_ts,),
         )
-        
         return await cur.fetchall()
 
-async def fetch_scheduled_post(post_id):
+@timed("db")
+async def reschedule_posts(rows):
+    """(run_at_ts, post_id) tuples for pending posts, in one transaction."""
     async with db_conn() as db:
-        cur = await db.execute("SELECT * FROM scheduled_posts WHERE id=?", (post_id,))
-        row = await cur.fetchone()
-        
-        return row
+        await db.executemany("UPDATE scheduled_posts SET run_at_ts=? WHERE id=? AND status='pending'", rows)
+        await db.commit()
 
-async def change_scheduled_post_status(post_id, status, updated_ts):
+@timed("db")
+async def fail_stuck_posts():
+    """Posts left 'sending' by a crash may or may not have gone out; mark them failed instead of resending."""
     async with db_conn() as db:
-            await db.execute(
-                "UPDATE scheduled_posts SET status=?, sent_ts=? WHERE id=?",
-                (status, updated_ts, post_id),
-            )
-            await db.commit()
\ No newline at end of file
+        cur = await db.execute("UPDATE scheduled_posts SET status='failed' WHERE status='sending'")
+        await db.commit()
+        return cur.rowcount
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import random
+import time
+
+from db import claim_due_posts, finish_scheduled_posts, next_scheduled_ts, fail_stuck_posts, expire_scheduled_posts, fetch_overdue_posts, reschedule_posts
+
+log = logging.getLogger("rothko-bot.dispatch")
+
+# One task sends every scheduled post. It sleeps until the earliest pending
+# run_at_ts (an indexed lookup), claims due posts in batches and wakes early
+# when notify_scheduled() reports new rows, so nothing is held per post.
+_task = None
+_wake = None
+_stopping = False
+_batch = 20
+_max_sleep = 3600
+_max_age = None
+
+async def start_dispatcher(send, batch = 20, max_age = None):
+    """send(row) posts one scheduled_posts row. Posts overdue by more than
+    max_age seconds are expired instead of sent, whenever they turn up."""
+    global _task, _wake, _stopping, _batch, _max_age
+    if _task is not None:
+        return
+    stuck = await fail_stuck_posts()
+    if stuck:
+        log.warning("Marked %d posts interrupted mid-send as failed", stuck)
+    _batch = max(1, batch)
+    _max_age = max_age
+    _wake = asyncio.Event()
+    _stopping = False
+    _task = asyncio.create_task(_run(send), name="post-dispatcher")
+
+async def catch_up(max_age, spread = 0):
+    """Deal with posts missed while the bot was down.
+
+    Posts overdue by more than max_age seconds are marked 'expired'. With
+    spread > 0 the rest are re-timed evenly (with jitter, order kept) over the
+    next `spread` seconds instead of going out back to back.
+    """
+    now = int(time.time())
+    expired = await expire_scheduled_posts(now - max_age, now)
+    late = await fetch_overdue_posts(now)
+    if late and spread > 0:
+        step = spread / len(late)
+        await reschedule_posts([(now + int(step * (i + random.random())), row["id"]) for i, row in enumerate(late)])
+    if expired or late:
+        log.info("Catch-up: %d missed posts expired, %d late posts to send", expired, len(late))
+
+def notify_scheduled():
+    if _wake is not None:
+        _wake.set()
+
+async def stop_dispatcher():
+    global _task, _stopping
+    if _task is None:
+        return
+    # Let the batch in flight finish so no post is left 'sending'.
+    _stopping = True
+    _wake.set()
+    await _task
+    _task = None
+
+async def _since(now):
+    """Lower bound for due posts, moved on every wake so posts added late
+    with a long-past run_at are expired rather than left pending."""
+    if _max_age is None:
+        return 0
+    since = now - _max_age
+    expired = await expire_scheduled_posts(since, now)
+    if expired:
+        log.info("Expired %d posts overdue by more than %ds", expired, _max_age)
+    return since
+
+async def _run(send):
+    while not _stopping:
+        _wake.clear()
+        try:
+            now = int(time.time())
+            since = await _since(now)
+            rows = await claim_due_posts(since, now, _batch)
+            results = []
+            for row in rows:
+                try:
+                    await send(row)
+                    results.append(("sent", int(time.time()), row["id"]))
+                    log.info("Posted scheduled photo id=%s", row["id"])
+                except Exception as e:
+                    results.append(("failed", int(time.time()), row["id"]))
+                    log.error("Failed to post scheduled photo id=%s: %s", row["id"], e)
+            await finish_scheduled_posts(results)
+            if len(rows) == _batch:
+                continue
+            next_ts = await next_scheduled_ts(since)
+        except Exception as e:
+            log.error("Scheduled post dispatch failed: %s", e)
+            next_ts = None
+        delay = _max_sleep if next_ts is None else min(_max_sleep, max(0, next_ts - time.time()))
+        try:
+            await asyncio.wait_for(_wake.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
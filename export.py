@@ -0,0 +1,129 @@
+"""Export chat history for offline analysis.
+
+    python -m export --out exports/ --format ndjson
+
+Writes gzip-compressed NDJSON or CSV: messages-YYYY-MM.<fmt>.gz per UTC
+month plus an activity.<fmt>.gz snapshot. Rows are streamed in chunks
+through short reads, so it is safe to run next to the bot. Progress is
+checkpointed after every chunk; rerunning resumes where it stopped and
+later runs append only new messages.
+"""
+import argparse
+import asyncio
+import csv
+import gzip
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import db
+
+MESSAGE_COLUMNS = ("chat_id", "message_id", "user_id", "ts", "reply_to_message_id", "thread_id", "first_reply_ts", "reply_count")
+ACTIVITY_COLUMNS = ("chat_id", "user_id", "username", "first_name", "last_name", "is_bot", "joined_ts", "first_msg_ts", "last_msg_ts")
+CHECKPOINT = "checkpoint.json"
+
+def _parse_args(argv):
+    p = argparse.ArgumentParser(description="Export messages and activity to compressed NDJSON/CSV.")
+    p.add_argument("--out", default="exports")
+    p.add_argument("--format", choices=("ndjson", "csv"), default="ndjson")
+    p.add_argument("--db", default=db.DB_PATH)
+    p.add_argument("--chunk", type=int, default=5000, help="rows per read and per checkpoint")
+    p.add_argument("--restart", action="store_true", help="ignore the checkpoint and export everything again")
+    return p.parse_args(argv)
+
+def _load_checkpoint(out, fmt, restart):
+    path = out / CHECKPOINT
+    if not restart and path.exists():
+        ckpt = json.loads(path.read_text(encoding="utf-8"))
+        if ckpt.get("format") == fmt:
+            return ckpt
+    return {"format": fmt, "messages": {}, "activity": None, "sizes": {}}
+
+def _save_checkpoint(out, ckpt):
+    tmp = out / (CHECKPOINT + ".tmp")
+    tmp.write_text(json.dumps(ckpt), encoding="utf-8")
+    os.replace(tmp, out / CHECKPOINT)
+
+def _rewind(out, ckpt):
+    """Cut every file back to its checkpointed size, dropping rows written after the last checkpoint."""
+    for path in out.glob(f"*.{ckpt['format']}.gz"):
+        size = ckpt["sizes"].get(path.name, 0)
+        if path.stat().st_size != size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+
+def _append(path, fmt, columns, rows):
+    """Append rows as one gzip member (members concatenate into a valid .gz); returns the new size."""
+    new = not path.exists() or path.stat().st_size == 0
+    with gzip.open(path, "at", encoding="utf-8", newline="") as f:
+        if fmt == "csv":
+            w = csv.writer(f)
+            if new:
+                w.writerow(columns)
+            w.writerows([r[c] for c in columns] for r in rows)
+        else:
+            f.writelines(json.dumps({c: r[c] for c in columns}, ensure_ascii=False) + "\n" for r in rows)
+    return path.stat().st_size
+
+async def _export_activity(out, ckpt, chunk):
+    fmt = ckpt["format"]
+    path = out / f"activity.{fmt}.gz"
+    after = ckpt["activity"]
+    if after is None:
+        # a finished snapshot is stale by now; take a fresh one
+        path.unlink(missing_ok=True)
+        ckpt["sizes"].pop(path.name, None)
+        after = [db.MIN_KEY, db.MIN_KEY]
+    count = 0
+    async for rows in db.iter_activity(tuple(after), chunk):
+        ckpt["sizes"][path.name] = await asyncio.to_thread(_append, path, fmt, ACTIVITY_COLUMNS, rows)
+        ckpt["activity"] = [rows[-1]["chat_id"], rows[-1]["user_id"]]
+        _save_checkpoint(out, ckpt)
+        count += len(rows)
+    ckpt["activity"] = None
+    _save_checkpoint(out, ckpt)
+    return count
+
+async def _export_messages(out, ckpt, chunk):
+    fmt = ckpt["format"]
+    # keyed by str(chat_id), as JSON object keys have to be strings
+    after = {int(chat_id): message_id for chat_id, message_id in ckpt["messages"].items()}
+    count = 0
+    async for rows in db.iter_messages(after, chunk):
+        by_month = {}
+        for r in rows:
+            by_month.setdefault(time.strftime("%Y-%m", time.gmtime(r["ts"])), []).append(r)
+        for month, month_rows in by_month.items():
+            path = out / f"messages-{month}.{fmt}.gz"
+            ckpt["sizes"][path.name] = await asyncio.to_thread(_append, path, fmt, MESSAGE_COLUMNS, month_rows)
+        ckpt["messages"][str(rows[-1]["chat_id"])] = rows[-1]["message_id"]
+        _save_checkpoint(out, ckpt)
+        count += len(rows)
+    return count
+
+async def export(out, fmt, db_path, chunk = 5000, restart = False):
+    out.mkdir(parents=True, exist_ok=True)
+    ckpt = _load_checkpoint(out, fmt, restart)
+    if restart:
+        ckpt["sizes"] = {}
+    _rewind(out, ckpt)
+    await db.open_db(db_path, readers=1)
+    try:
+        users = await _export_activity(out, ckpt, chunk)
+        messages = await _export_messages(out, ckpt, chunk)
+    finally:
+        await db.close_db()
+    return users, messages
+
+def main(argv = None):
+    args = _parse_args(argv if argv is not None else sys.argv[1:])
+    if not os.path.exists(args.db):
+        sys.exit(f"No database at {args.db}")
+    started = time.perf_counter()
+    users, messages = asyncio.run(export(Path(args.out), args.format, args.db, max(1, args.chunk), args.restart))
+    print(f"Exported {users} users and {messages} new messages to {args.out} in {time.perf_counter() - started:.1f}s")
+
+if __name__ == "__main__":
+    main()
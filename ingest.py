@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import sqlite3
+
+from active import note_active, forget_active
+from cache import report_cache
+from db import ingest_batch, delete_user
+from util import tz_table, timezone_
+
+log = logging.getLogger("rothko-bot.ingest")
+
+# Write-behind buffer for message_tracker. Handlers only put a tuple on a
+# bounded queue; a single background task coalesces the rows and writes them
+# with one transaction every flush interval or every `flush_rows` items.
+_queue = None
+_task = None
+_flush_interval = 0.5
+_flush_rows = 200
+_retry_attempts = 6
+_retry_max_delay = 30
+_stopping = None
+
+DELETE = "delete"
+
+# SQLITE_BUSY / SQLITE_LOCKED: another connection holds the lock. Everything
+# else (no such table, too many variables, disk full) will not clear by waiting.
+_TRANSIENT_CODES = (5, 6)
+
+async def start_ingest(flush_ms = 500, flush_rows = 200, max_queue = 5000):
+    global _queue, _task, _flush_interval, _flush_rows, _stopping
+    if _task is not None:
+        return
+    _flush_interval = max(0.01, flush_ms / 1000)
+    _flush_rows = max(1, flush_rows)
+    _queue = asyncio.Queue(maxsize=max(1, max_queue))
+    _stopping = asyncio.Event()
+    _task = asyncio.create_task(_run(), name="ingest-flush")
+
+async def stop_ingest():
+    global _queue, _task
+    if _task is None:
+        return
+    # A flush waiting to retry gives up now, so a locked database cannot hang shutdown.
+    _stopping.set()
+    # The sentinel goes through the queue, so everything enqueued before it is flushed.
+    await _queue.put(None)
+    await _task
+    _queue = None
+    _task = None
+
+async def enqueue_message(chat_id, user, message_id, ts, reply_to, thread_id):
+    """Queue one tracked message. Blocks only when the queue is full (backpressure)."""
+    profile = (chat_id, user.id, user.username, user.first_name, user.last_name, int(user.is_bot), ts)
+    await _queue.put((profile, (chat_id, message_id, user.id, ts, reply_to, thread_id)))
+
+async def enqueue_profile(chat_id, user):
+    """Queue a profile seen in a chat without a tracked message, to keep names and usernames current."""
+    profile = (chat_id, user.id, user.username, user.first_name, user.last_name, int(user.is_bot), None)
+    await _queue.put((profile, None))
+
+async def enqueue_delete(chat_id, user_id):
+    """Queue forgetting a user who left. It runs in order with the buffered
+    rows, so their last messages are written first and then deleted, instead
+    of landing after the delete and bringing the user back."""
+    await _queue.put((DELETE, (chat_id, user_id)))
+
+async def _run():
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        item = await _queue.get()
+        if item is None:
+            break
+        batch = [item]
+        deadline = loop.time() + _flush_interval
+        while len(batch) < _flush_rows:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+        await _flush(batch)
+
+async def _flush(batch):
+    # A delete splits the batch: rows queued before it are written first.
+    rows = []
+    for item in batch:
+        if item[0] == DELETE:
+            await _ingest(rows)
+            rows = []
+            await _delete(*item[1])
+        else:
+            rows.append(item)
+    await _ingest(rows)
+
+async def _delete(chat_id, user_id):
+    await _write(f"the delete of user {user_id}", delete_user, chat_id, user_id, tz_table(timezone_(chat_id)).local_day)
+    forget_active(chat_id, user_id)
+    report_cache.invalidate(chat_id)
+
+async def _ingest(batch):
+    if not batch:
+        return
+    users = {}
+    messages = []
+    for profile, message in batch:
+        # The newest profile wins; message timestamps widen to (last_msg_ts, first_msg_ts).
+        key = profile[:2]
+        ts = profile[6]
+        prev = users.get(key)
+        last_ts, first_ts = (prev[6], prev[7]) if prev is not None else (None, None)
+        if ts is not None:
+            last_ts = ts if last_ts is None else max(last_ts, ts)
+            first_ts = ts if first_ts is None else min(first_ts, ts)
+        users[key] = profile[:6] + (last_ts, first_ts)
+        if message is not None:
+            messages.append(message)
+    # rollup days follow each chat's own timezone
+    day_of = {}
+    for m in messages:
+        if m[0] not in day_of:
+            day_of[m[0]] = tz_table(timezone_(m[0])).local_day
+    days = [day_of[m[0]](m[3]) for m in messages]
+    active = await _write(f"{len(messages)} buffered messages", ingest_batch, list(users.values()), messages, days)
+    if active is None:
+        return
+    note_active(active)
+    for chat_id in {m[0] for m in messages}:
+        report_cache.invalidate(chat_id)
+
+def _transient(e):
+    code = getattr(e, "sqlite_errorcode", None)
+    if code is None:
+        return "locked" in str(e)
+    # extended codes (e.g. SQLITE_BUSY_SNAPSHOT) keep the primary code in the low byte
+    return (code & 0xFF) in _TRANSIENT_CODES
+
+async def _write(what, func, *args):
+    """func(*args), retrying busy/locked errors with backoff. The failed
+    transaction was rolled back, so the same write can go again; handlers
+    block on the full queue meanwhile. Gives up, logs the drop and returns
+    None after _retry_attempts, on any other error, or once stop_ingest()
+    has been called."""
+    attempt = 0
+    while True:
+        try:
+            return await func(*args)
+        except sqlite3.OperationalError as e:
+            if not _transient(e) or attempt >= _retry_attempts or _stopping.is_set():
+                log.error("Dropping %s after %d attempts: %s", what, attempt + 1, e)
+                return None
+            delay = min(_retry_max_delay, 0.5 * 2 ** attempt)
+            attempt += 1
+            log.warning("Failed to write %s (%s), retry %d in %.1fs", what, e, attempt, delay)
+            try:
+                await asyncio.wait_for(_stopping.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        except Exception:
+            log.exception("Dropping %s that cannot be written", what)
+            return None
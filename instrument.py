@@ -0,0 +1,126 @@
+import asyncio
+import json
+import logging
+import time
+from bisect import bisect_left
+from functools import wraps
+
+from telegram.request import HTTPXRequest
+
+log = logging.getLogger("rothko-bot.instrument")
+
+# Histogram bucket upper bounds in milliseconds; the last bucket is open-ended.
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms, error = False):
+        self.buckets[bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.errors += bool(error)
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def quantile(self, q):
+        """Estimate by linear interpolation inside the bucket holding the q-th observation."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            if n and seen + n >= rank:
+                lower = BUCKETS_MS[i - 1] if i else 0.0
+                upper = BUCKETS_MS[i] if i < len(BUCKETS_MS) else self.max_ms
+                return min(self.max_ms, lower + (upper - lower) * (rank - seen) / n)
+            seen += n
+        return self.max_ms
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "p50_ms": round(self.quantile(0.5), 3),
+            "p90_ms": round(self.quantile(0.9), 3),
+            "p99_ms": round(self.quantile(0.99), 3),
+            "max_ms": round(self.max_ms, 3),
+            "buckets": dict(zip([*map(str, BUCKETS_MS), "inf"], self.buckets)),
+        }
+
+# Totals since start (for /latency) and the window since the last flush (for the NDJSON dump).
+_totals = {}
+_window = {}
+
+def record(name, seconds, error = False):
+    ms = seconds * 1000
+    for stats in (_totals, _window):
+        hist = stats.get(name)
+        if hist is None:
+            hist = stats[name] = Histogram()
+        hist.observe(ms, error)
+
+def timed(prefix, name = None):
+    """Decorator recording latency and errors of an async function as `prefix.name`."""
+    def decorator(func):
+        metric = f"{prefix}.{name or func.__name__}"
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            error = False
+            try:
+                return await func(*args, **kwargs)
+            except BaseException:
+                error = True
+                raise
+            finally:
+                record(metric, time.perf_counter() - started, error)
+        return wrapper
+    return decorator
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records every Bot API call as `api.<method>`."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        error = True
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            error = code >= 400
+            return code, payload
+        finally:
+            record(f"api.{endpoint}", time.perf_counter() - started, error)
+
+def _append_lines(path, lines):
+    with open(path, "a", encoding="utf-8") as f:
+        f.writelines(line + "\n" for line in lines)
+
+async def flush_metrics(path):
+    """Append one NDJSON line per metric for the window since the last flush."""
+    global _window
+    window, _window = _window, {}
+    if not window or not path:
+        return
+    now = int(time.time())
+    lines = [json.dumps({"ts": now, "name": name, **hist.as_dict()}, ensure_ascii=False) for name, hist in sorted(window.items())]
+    try:
+        await asyncio.to_thread(_append_lines, path, lines)
+    except OSError as e:
+        log.warning("Could not write metrics to %s: %s", path, e)
+
+def latency_report(limit = 40):
+    if not _totals:
+        return "No latency samples yet."
+    rows = sorted(_totals.items(), key=lambda kv: -kv[1].total_ms)[:limit]
+    lines = ["⏲️ Latency since start (by total time):"]
+    for name, hist in rows:
+        lines.append(
+            f"{name} — n={hist.count}, err={hist.errors}, p50={hist.quantile(0.5):.1f}ms, p99={hist.quantile(0.99):.1f}ms"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,39 @@
+import time
+
+from db import fetch_reply_deltas, fetch_reply_sketches, save_reply_sketches
+from sketch import QuantileSketch
+from util import local_day, tz_table, day_start_ts, timezone_
+
+# Time-to-first-reply percentiles come from one QuantileSketch per local day
+# (the day of the replied-to message), merged over the window. A day's sketch
+# is stored once it is SETTLE_DAYS old, by when its late first replies are in;
+# newer days are sketched from messages on every call, which is a short scan.
+SETTLE_DAYS = 2
+
+async def _sketch_days(chat_id, start_day, end_day, tz):
+    """Fresh sketches for start_day..end_day from raw messages, empty days included."""
+    sketches = {day: QuantileSketch() for day in range(start_day, end_day + 1)}
+    day_of = tz_table(tz).local_day
+    for ts, delta in await fetch_reply_deltas(chat_id, day_start_ts(start_day, tz), day_start_ts(end_day + 1, tz)):
+        sketches[day_of(ts)].add(delta)
+    return sketches
+
+async def reply_sketch(chat_id, start_day, end_day):
+    """Merged reply-latency sketch for local days start_day..end_day."""
+    tz = timezone_(chat_id)
+    settled = min(end_day, local_day(int(time.time()), tz) - SETTLE_DAYS)
+    merged = QuantileSketch()
+    stored = await fetch_reply_sketches(chat_id, start_day, settled)
+    for text in stored.values():
+        merged.merge(QuantileSketch.from_json(text))
+    missing = [day for day in range(start_day, settled + 1) if day not in stored]
+    if missing:
+        built = await _sketch_days(chat_id, missing[0], missing[-1], tz)
+        new = [(day, built[day]) for day in missing]
+        await save_reply_sketches(chat_id, [(day, s.to_json()) for day, s in new])
+        for _, s in new:
+            merged.merge(s)
+    if end_day > settled:
+        for s in (await _sketch_days(chat_id, max(start_day, settled + 1), end_day, tz)).values():
+            merged.merge(s)
+    return merged
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+from config import CONFIG
+
+log = logging.getLogger("rothko-bot.ratelimit")
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, at most `capacity` banked."""
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Hold every caller for `seconds` (used when Telegram answers RetryAfter)."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+def _retry_seconds(retry_after):
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+class ApiExecutor:
+    """Runs Bot API calls with bounded concurrency, a per-bot and a per-chat
+    token bucket, and automatic backoff on RetryAfter.
+
+    The per-chat bucket models Telegram's limit on sending to a chat; pass
+    chat_id=None for reads such as get_chat_member so they only use the
+    per-bot bucket."""
+
+    def __init__(self, concurrency = 8, rate = 30, chat_rate = 20 / 60, max_retries = 3):
+        self.concurrency = max(1, concurrency)
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self._sem = asyncio.Semaphore(self.concurrency)
+        self._global = TokenBucket(rate, max(1, rate))
+        self._chats = {}
+
+    def set_chat_rate(self, chat_id, rate, burst = 1):
+        self._chats[chat_id] = TokenBucket(rate, burst)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, max(1, self.chat_rate))
+        return bucket
+
+    async def call(self, chat_id, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            async with self._sem:
+                await self._global.acquire()
+                if chat_id is not None:
+                    await self._chat_bucket(chat_id).acquire()
+                try:
+                    return await func(*args, **kwargs)
+                except RetryAfter as e:
+                    attempt += 1
+                    if attempt > self.max_retries:
+                        raise
+                    delay = _retry_seconds(e.retry_after)
+                    log.warning("Flood control for chat %s, retrying in %.1fs", chat_id, delay)
+                    (self._chat_bucket(chat_id) if chat_id is not None else self._global).pause(delay)
+
+    async def map(self, chat_id, func, items):
+        """Submit `func(item)` for every item at once; failures come back as exceptions."""
+        return await asyncio.gather(
+            *(self.call(chat_id, func, item) for item in items),
+            return_exceptions=True,
+        )
+
+api = ApiExecutor(
+    concurrency=CONFIG.get("api_concurrency", 8),
+    rate=CONFIG.get("api_rate_per_sec", 30),
+    chat_rate=CONFIG.get("api_chat_rate_per_sec", 20 / 60),
+)
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import time
+
+from db import delete_messages_before, incremental_vacuum, fetch_meta, set_meta, rollups_need_backfill
+from util import local_day, day_start_ts, timezone_
+
+log = logging.getLogger("rothko-bot.retention")
+
+# /metrics and /replytime read raw messages for at most 90 days; everything
+# older is served from daily_user_counts, hourly_counts and activity_days,
+# which ingest_batch keeps current, so old raw rows can simply be dropped.
+MIN_RETENTION_DAYS = 91
+VACUUM_PAGES = 2000
+
+def horizon_key(chat_id):
+    return f"compacted_before:{chat_id}"
+
+async def compacted_before(chat_id):
+    """Raw messages older than this were compacted away (None if never)."""
+    return await fetch_meta(horizon_key(chat_id))
+
+async def compact_messages(chat_id, keep_days, batch_rows = 2000, pause = 0.05):
+    """Drop raw messages older than keep_days local days, in small write transactions.
+
+    Returns the number of rows deleted.
+    """
+    keep_days = max(MIN_RETENTION_DAYS, keep_days)
+    if await rollups_need_backfill(chat_id):
+        log.warning("Rollups for chat %s are not built yet; keeping raw messages", chat_id)
+        return 0
+    tz = timezone_(chat_id)
+    cutoff = day_start_ts(local_day(int(time.time()), tz) - keep_days, tz)
+    # Record the horizon first: a rollup rebuild after a crash mid-way must
+    # already leave the compacted days alone.
+    if cutoff > (await compacted_before(chat_id) or 0):
+        await set_meta(horizon_key(chat_id), cutoff)
+    deleted = 0
+    while True:
+        n = await delete_messages_before(chat_id, cutoff, batch_rows)
+        deleted += n
+        if n < batch_rows:
+            break
+        # let the ingest flush and other writers take the lock between batches
+        await asyncio.sleep(pause)
+    return deleted
+
+async def vacuum(pause = 0.05):
+    # Only ever incremental: the one-time switch to auto_vacuum=INCREMENTAL is a
+    # full VACUUM that would hold the writer for its whole run, so it is left to /vacuum_setup.
+    free = None
+    while True:
+        left = await incremental_vacuum(VACUUM_PAGES)
+        if left is None:
+            log.info("auto_vacuum is not INCREMENTAL; freed pages stay in the file (see /vacuum_setup)")
+            break
+        if not left or left == free:
+            break
+        free = left
+        await asyncio.sleep(pause)
+
+async def run_retention(chat_id, keep_days, batch_rows = 2000):
+    started = time.monotonic()
+    deleted = await compact_messages(chat_id, keep_days, batch_rows)
+    if deleted:
+        await vacuum()
+    log.info("Retention: dropped %d raw messages older than %dd in %.1fs", deleted, max(MIN_RETENTION_DAYS, keep_days), time.monotonic() - started)
+    return deleted
@@ -0,0 +1,73 @@
+"""Mergeable quantile sketch for non-negative values such as reply latencies.
+
+Values are counted in logarithmic buckets: bucket i holds values in
+(gamma**(i-1), gamma**i] with gamma = (1+alpha)/(1-alpha), so every quantile
+comes back within relative error alpha whatever the range of the data. Two
+sketches merge by adding bucket counts, which lets one sketch per day be
+combined into any window. In SQLite a sketch is kept as compact JSON.
+"""
+import json
+import math
+
+class QuantileSketch:
+    def __init__(self, alpha = 0.01):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self.gamma)
+        self.zeros = 0
+        self.bins = {}
+        self.count = 0
+
+    def add(self, value, n = 1):
+        if value <= 0:
+            self.zeros += n
+        else:
+            i = math.ceil(math.log(value) / self._log_gamma)
+            self.bins[i] = self.bins.get(i, 0) + n
+        self.count += n
+
+    def merge(self, other):
+        if other.alpha != self.alpha:
+            raise ValueError("cannot merge sketches with different alpha")
+        self.zeros += other.zeros
+        for i, n in other.bins.items():
+            self.bins[i] = self.bins.get(i, 0) + n
+        self.count += other.count
+        return self
+
+    def _ranks(self, ranks):
+        """{rank: value} for 0-based ranks, in one pass over the buckets."""
+        todo = sorted(set(ranks), reverse=True)
+        found = {}
+        seen = self.zeros
+        while todo and todo[-1] < seen:
+            found[todo.pop()] = 0.0
+        for i in sorted(self.bins):
+            seen += self.bins[i]
+            while todo and todo[-1] < seen:
+                found[todo.pop()] = 2 * self.gamma ** i / (self.gamma + 1)
+        return found
+
+    def quantiles(self, ps):
+        """Estimates for several p at once, interpolated between ranks like util.percentile."""
+        if not self.count:
+            return [0.0 for _ in ps]
+        last = self.count - 1
+        ranks = [(last * p, int(last * p), min(int(last * p) + 1, last)) for p in ps]
+        values = self._ranks([r for _, f, c in ranks for r in (f, c)])
+        return [values[f] if f == c else values[f] * (c - k) + values[c] * (k - f) for k, f, c in ranks]
+
+    def quantile(self, p):
+        return self.quantiles((p,))[0]
+
+    def to_json(self):
+        return json.dumps({"a": self.alpha, "z": self.zeros, "b": sorted(self.bins.items())}, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        sketch = cls(data["a"])
+        sketch.zeros = data["z"]
+        sketch.bins = {i: n for i, n in data["b"]}
+        sketch.count = sketch.zeros + sum(sketch.bins.values())
+        return sketch
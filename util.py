@@ -1,8 +1,12 @@
 import os
 import re
+import json
+import base64
+from bisect import bisect_right
+from functools import lru_cache, wraps
 from config import CONFIG
 from zoneinfo import ZoneInfo
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
 from telegram import ChatPermissions
 
 def get_job_queue(app):
@@ -12,8 +16,8 @@ def get_job_queue(app):
 def escape_md(text):
     return re.sub(r'([_*[\]()~`>#+\-=|{}.!])', r'\\\1', text)
 
-def get_rules_text():
-    path = CONFIG.get("rules_message_file")
+def get_rules_text(chat_id = None):
+    path = chat_setting(chat_id, "rules_message_file")
     if path and os.path.exists(path):
         try:
             with open(path, "r", encoding="utf-8") as f:
@@ -22,18 +26,35 @@ def get_rules_text():
             pass
     return "Кто спиздил правила? Верните"
 
-def percentile(p, values):
-    if not values:
-        return 0.0
+def encode_cursor(data):
+    """Opaque URL-safe token for a JSON-serialisable page cursor."""
+    raw = json.dumps(data, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except ValueError:
+        return None
+
+def percentiles(ps, values):
+    """percentile() for several p at once, sorting the values only once."""
+    if not len(values):
+        return [0.0 for _ in ps]
     values = sorted(values)
-    k = (len(values)-1) * p
-    f = int(k)
-    c = min(f+1, len(values)-1)
-    if f == c:
-        return float(values[int(k)])
-    d0 = values[f] * (c - k)
-    d1 = values[c] * (k - f)
-    return float(d0 + d1)
+    out = []
+    for p in ps:
+        k = (len(values)-1) * p
+        f = int(k)
+        c = min(f+1, len(values)-1)
+        if f == c:
+            out.append(float(values[f]))
+        else:
+            out.append(float(values[f] * (c - k) + values[c] * (k - f)))
+    return out
+
+def percentile(p, values):
+    return percentiles((p,), values)[0]
 
 #############
 # VARIABLES #
@@ -101,23 +122,107 @@ def parse_hhmm(value):
 def localize(ts, tz):
     return datetime.fromtimestamp(ts, tz=timezone.utc).astimezone(tz)
 
-def rules_timezone():
+# Rollup tables key days as the local calendar day (configured tz),
+# counted in days since 1970-01-01.
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def _utc_offset(ts, tz):
+    return int(datetime.fromtimestamp(ts, tz).utcoffset().total_seconds())
+
+# Span covered by TzTable; 2100-01-01 UTC.
+TZ_TABLE_END = 4102444800
+
+class TzTable:
+    """UTC offsets of a zone as a sorted list of transitions.
+
+    A timestamp maps to its local day, weekday and hour with one bisect and
+    integer arithmetic, no datetime per row. The zone is sampled once a day
+    and every change is bisected down to the second, so DST switches land
+    exactly. Timestamps outside 1970..2100 fall back to zoneinfo.
+    """
+    def __init__(self, tz, start_ts = 0, end_ts = TZ_TABLE_END):
+        self.tz = tz
+        self.start_ts = start_ts
+        self.end_ts = end_ts
+        self.starts = [start_ts]
+        self.offsets = [_utc_offset(start_ts, tz)]
+        ts = start_ts
+        while ts < end_ts:
+            nxt = min(ts + 86400, end_ts)
+            if _utc_offset(nxt, tz) == self.offsets[-1]:
+                ts = nxt
+                continue
+            lo, hi = ts, nxt
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if _utc_offset(mid, tz) == self.offsets[-1]:
+                    lo = mid
+                else:
+                    hi = mid
+            self.starts.append(hi)
+            self.offsets.append(_utc_offset(hi, tz))
+            ts = hi
+
+    def offset(self, ts):
+        if self.start_ts <= ts < self.end_ts:
+            return self.offsets[bisect_right(self.starts, ts) - 1]
+        return _utc_offset(ts, self.tz)
+
+    def local_day(self, ts):
+        return (ts + self.offset(ts)) // 86400
+
+    def weekday_hour(self, ts):
+        local = ts + self.offset(ts)
+        return (local // 86400 + 3) % 7, local % 86400 // 3600  # 1970-01-01 was a Thursday
+
+@lru_cache(maxsize=8)
+def tz_table(tz):
+    return TzTable(tz)
+
+def local_day(ts, tz):
+    return tz_table(tz).local_day(ts)
+
+def day_to_date(day):
+    return date.fromordinal(day + EPOCH_ORDINAL)
+
+def day_start_ts(day, tz):
+    return int(datetime.combine(day_to_date(day), datetime.min.time(), tz).timestamp())
+
+def rules_timezone(chat_id = None):
     try:
-        return ZoneInfo(CONFIG.get("rules_tz", "UTC"))
+        return ZoneInfo(chat_setting(chat_id, "rules_tz", "UTC"))
     except Exception:
         return ZoneInfo("UTC")
 
-def timezone_():
+def timezone_(chat_id = None):
     try:
-        return ZoneInfo(CONFIG.get("tz", "UTC"))
+        return ZoneInfo(chat_setting(chat_id, "tz", "UTC"))
     except Exception:
         return ZoneInfo("UTC")
 
+#########
+# CHATS #
+#########
+
+def chat_ids():
+    return [chat["chat_id"] for chat in CONFIG.get("chats", ())]
+
+def is_tracked(chat_id):
+    return chat_id in chat_ids()
+
+def chat_setting(chat_id, key, default = None):
+    """A per-chat override from CONFIG["chats"], else the top-level setting."""
+    for chat in CONFIG.get("chats", ()):
+        if chat["chat_id"] == chat_id and key in chat:
+            return chat[key]
+    return CONFIG.get(key, default)
+
 ##############
 # OWNER AUTH #
 ##############
 
 def owners_only(func):
+    @wraps(func)
     async def wrapper(update, context, *args, **kwargs):
         u = update.effective_user
         if not u or u.id not in metrics_owners():
@@ -136,6 +241,7 @@ def metrics_owners():
 #############
 
 def requires_auth(func):
+    @wraps(func)
     async def wrapper(update, context, *args, **kwargs):
         channel_id = CONFIG.get("channel_id")
         chat_id = CONFIG.get("chat_id")
@@ -148,7 +254,7 @@ async def is_authorized(update, context, channel_id, chat_id):
     u = update.effective_user
     if not u:
         return False
-    if await is_channel_admin(u.id, context, channel_id, chat_id):
+    if await is_channel_admin(u.id, context, channel_id):
         return True
     chat = update.effective_chat
     if chat and chat.type in ("group", "supergroup"):